@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_match.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+'''
+Offline benchmark of the MatchRules engine and the Match actor.
+
+Generates a synthetic rule set and event stream and reports events/s,
+per event latency percentiles and peak memory as one JSON document per
+scenario so runs can be compared across commits.
+
+Scenarios:
+
+    matchrules: Evaluates every condition through MatchRules.do() the way
+                rules were evaluated before they were compiled.
+    ruleset:    Evaluates the compiled RuleSet through the index and an
+                Evaluation per event without routing.
+    actor:      Feeds the events through the inbox of a running Match actor
+                and waits for each event to reach the success queue.
+                The events are submitted as fast as the inbox accepts them
+                so the latency includes the time spent queued.
+
+The "re" operator generates patterns anchored at the start of the value
+and "re.*" patterns which can match anywhere in the value.
+
+Example:
+
+    python benchmarks/bench_match.py --rules 1000 --conditions 3 \\
+        --operators "==:4,re:2,>:1,in:1" --depth 2 --events 5000 \\
+        --match-rate 0.1 --output results.jsonl
+'''
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gevent import spawn, sleep
+from wishbone.actor import ActorConfig
+from wishbone.event import Event
+from wishbone.error import QueueFull
+from wishbone_flow_match import Match
+from wishbone_flow_match.matchrules import MatchRules
+from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+VOCABULARY = 1000
+
+
+def parseOperators(operators):
+    '''Parses "==:4,re:2" into a list of (operator, weight) tuples.'''
+
+    result = []
+    for item in operators.split(","):
+        operator, weight = item.rsplit(":", 1)
+        result.append((operator, float(weight)))
+    return result
+
+
+def generateFields(count, depth):
+    '''Returns <count> field names nested <depth> levels deep.'''
+
+    fields = []
+    for number in range(count):
+        fields.append(".".join(["field%s" % (number)] + ["level%s" % (level) for level in range(1, depth)]))
+    return fields
+
+
+def generateCondition(operator, rnd):
+    '''Returns a condition string and a value satisfying it.'''
+
+    word = "v%s" % (rnd.randint(0, VOCABULARY))
+    number = rnd.randint(0, 100)
+    if operator == "==":
+        return "==:%s" % (word), word
+    elif operator == "re":
+        return "re:^%s-" % (word), "%s-suffix" % (word)
+    elif operator == "re.*":
+        return "re:.*-%s-.*" % (word), "prefix-%s-suffix" % (word)
+    elif operator == "in":
+        return "in:%s" % (word), ["other", word]
+    elif operator == "=":
+        return "=:%s" % (number), number
+    elif operator == ">":
+        return ">:%s" % (number), number + 1
+    elif operator == ">=":
+        return ">=:%s" % (number), number
+    elif operator == "<":
+        return "<:%s" % (number), number - 1
+    elif operator == "<=":
+        return "<=:%s" % (number), number
+    else:
+        raise Exception("Operator '%s' is not supported by the generator." % (operator))
+
+
+def generateRules(count, conditions, operators, fields, rnd):
+    '''Returns a dict of rules and a dict of the values satisfying each
+    rule.'''
+
+    names = [operator for operator, weight in operators]
+    weights = [weight for operator, weight in operators]
+    rules = {}
+    satisfying = {}
+    for number in range(count):
+        name = "rule%s" % (number)
+        condition = []
+        values = {}
+        for field in rnd.sample(fields, conditions):
+            c, value = generateCondition(rnd.choices(names, weights)[0], rnd)
+            condition.append({field: c})
+            values[field] = value
+        rules[name] = {"condition": condition, "queue": [{"outbox": {"rule": name}}]}
+        satisfying[name] = values
+    return rules, satisfying
+
+
+def nest(data, field, value):
+
+    keys = field.split(".")
+    for key in keys[:-1]:
+        data = data.setdefault(key, {})
+    data[keys[-1]] = value
+
+
+def generateEvents(count, fields, satisfying, match_rate, rnd):
+    '''Returns a list of event payloads of which a fraction of
+    <match_rate> satisfies a random rule.  The other payloads carry values
+    which do not satisfy any of the generated conditions.'''
+
+    names = sorted(satisfying.keys())
+    events = []
+    for number in range(count):
+        data = {}
+        for field in fields:
+            nest(data, field, "nan")
+        if names and rnd.random() < match_rate:
+            for field, value in satisfying[rnd.choice(names)].items():
+                nest(data, field, value)
+        events.append(data)
+    return events
+
+
+def percentiles(latencies):
+
+    latencies = sorted(latencies)
+    result = {}
+    for percentile in [50, 90, 99, 99.9]:
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))
+        result["p%s" % (percentile)] = latencies[index] if latencies else None
+    return result
+
+
+def benchMatchRules(rules, events):
+
+    match = MatchRules()
+    latencies = []
+    matches = 0
+    for data in events:
+        event = Event(data)
+        start = time.perf_counter()
+        for rule in rules.values():
+            for condition in rule["condition"]:
+                field, value = list(condition.items())[0]
+                key = "@data.%s" % (field)
+                if not event.has(key):
+                    break
+                try:
+                    if not match.do(value, event.get(key)):
+                        break
+                except Exception:
+                    break
+            else:
+                matches += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, matches
+
+
+def benchRuleSet(rules, events):
+
+    match = MatchRules()
+    ruleset = RuleSet(rules, match)
+    actor = Match(ActorConfig("bench", 100, 1, {}, ""))
+    latencies = []
+    matches = 0
+    for data in events:
+        event = Event(data)
+        start = time.perf_counter()
+        evaluation = Evaluation(ruleset, event)
+        for rule in ruleset.candidates(evaluation):
+            if actor.evaluateCondition(rule, evaluation):
+                matches += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, matches
+
+
+def benchActor(rules, events, options):
+
+    actor = Match(ActorConfig("bench", len(events) + 1, 1, {}, ""), rules=rules, **options)
+    actor.pool.createQueue("outbox")
+    actor.pool.queue.inbox.disableFallThrough()
+    actor.pool.queue.success.disableFallThrough()
+    actor.start()
+
+    started = {}
+    latencies = []
+
+    def produce():
+        for data in events:
+            event = Event(data)
+            started[id(event)] = time.perf_counter()
+            while True:
+                try:
+                    actor.pool.queue.inbox.put(event)
+                    break
+                except QueueFull:
+                    sleep(0)
+
+    spawn(produce)
+    while len(latencies) < len(events):
+        event = actor.pool.queue.success.get()
+        latencies.append(time.perf_counter() - started.pop(id(event)))
+    matches = actor.pool.queue.outbox.stats()["dropped_total"]
+    actor.stop()
+    return latencies, matches
+
+
+def gitCommit():
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the Match actor and MatchRules engine.")
+    parser.add_argument("--rules", type=int, default=1000, help="The number of rules.")
+    parser.add_argument("--conditions", type=int, default=3, help="The number of conditions per rule.")
+    parser.add_argument("--operators", default="==:4,re:2,>:1,<=:1,in:1", help="The operator mix as operator:weight pairs.")
+    parser.add_argument("--fields", type=int, default=10, help="The number of distinct fields.")
+    parser.add_argument("--depth", type=int, default=1, help="The nesting depth of the fields.")
+    parser.add_argument("--events", type=int, default=2000, help="The number of events.")
+    parser.add_argument("--match-rate", type=float, default=0.1, help="The fraction of events satisfying a rule.")
+    parser.add_argument("--seed", type=int, default=1, help="The random seed.")
+    parser.add_argument("--scenario", action="append", choices=["matchrules", "ruleset", "actor"], help="The scenario to run.  Can be repeated.  Default: all")
+    parser.add_argument("--option", action="append", default=[], help="A Match actor parameter as key=value (JSON value) for the actor scenario.")
+    parser.add_argument("--trace-memory", action="store_true", help="Measures the peak of allocated memory per scenario using tracemalloc.")
+    parser.add_argument("--output", help="Appends the results to this file instead of writing them to stdout.")
+    args = parser.parse_args()
+
+    if args.conditions > args.fields:
+        parser.error("--conditions can not be bigger than --fields.")
+
+    rnd = random.Random(args.seed)
+    fields = generateFields(args.fields, args.depth)
+    rules, satisfying = generateRules(args.rules, args.conditions, parseOperators(args.operators), fields, rnd)
+    events = generateEvents(args.events, fields, satisfying, args.match_rate, rnd)
+    options = dict([(o.split("=", 1)[0], json.loads(o.split("=", 1)[1])) for o in args.option])
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    for scenario in args.scenario or ["matchrules", "ruleset", "actor"]:
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        if scenario == "matchrules":
+            latencies, matches = benchMatchRules(rules, events)
+        elif scenario == "ruleset":
+            latencies, matches = benchRuleSet(rules, events)
+        else:
+            latencies, matches = benchActor(rules, events, options)
+        elapsed = time.perf_counter() - start
+
+        result = {"scenario": scenario,
+                  "commit": gitCommit(),
+                  "time": time.time(),
+                  "python": sys.version.split()[0],
+                  "parameters": {"rules": args.rules,
+                                 "conditions": args.conditions,
+                                 "operators": args.operators,
+                                 "fields": args.fields,
+                                 "depth": args.depth,
+                                 "events": args.events,
+                                 "match_rate": args.match_rate,
+                                 "seed": args.seed,
+                                 "options": options if scenario == "actor" else {}},
+                  "matches": matches,
+                  "elapsed": elapsed,
+                  "events_per_second": len(events) / elapsed if elapsed else None,
+                  "latency": percentiles(latencies),
+                  "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        if args.trace_memory:
+            result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        output.write("%s\n" % (json.dumps(result, sort_keys=True)))
+        output.flush()
+
+
+if __name__ == '__main__':
+    main()
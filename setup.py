@@ -30,8 +30,7 @@ PROJECT = 'wishbone_flow_match'
 VERSION = '1.2.6'
 
 install_requires = [
-    'wishbone>=2.1.1',
-    'deepdiff'
+    'wishbone>=2.1.1'
 ]
 
 try:
@@ -76,6 +75,7 @@ setup(
                  ],
     extras_require={
         'testing': ['pytest'],
+        'numpy': ['numpy'],
     },
     platforms=['Linux'],
     test_suite='tests.test_wishbone',
@@ -27,16 +27,20 @@ from wishbone.utils.test import getter
 from wishbone_flow_match import Match
 from wishbone.actor import ActorConfig
 from gevent import sleep
+import os
+import re
+import signal
 
 
-def generate_actor(rules):
+def generate_actor(rules, queues=[], **kwargs):
 
     actor_config = ActorConfig('match', 100, 1, {}, "")
-    match = Match(actor_config, rules=rules)
+    match = Match(actor_config, rules=rules, **kwargs)
 
     match.pool.queue.inbox.disableFallThrough()
-    for queue in rules.keys():
-        match.pool.createQueue(queue)
+    for queue in list(rules.keys()) + queues:
+        if not match.pool.hasQueue(queue):
+            match.pool.createQueue(queue)
         getattr(match.pool.queue, queue).disableFallThrough()
 
     match.start()
@@ -353,3 +357,955 @@ def test_dict_depth():
     e = Event({"regex": {"one": {"two": {"three": "one two three"}}}})
     actor.pool.queue.inbox.put(e)
     assert getter(actor.pool.queue.regex).get()["regex"] == {"one": {"two": {"three": "one two three"}}}
+
+
+def test_compile_condition():
+
+    from wishbone_flow_match.matchrules import MatchRules
+
+    match = MatchRules()
+    assert match.compile("re:^one")("one two")
+    assert not match.compile(">=:10")("9")
+    assert match.compile("in:two")(["one", "two"])
+
+    for condition in ["nonsense", "~:10", ">:ten", "re:(", 10]:
+        try:
+            match.compile(condition)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("Condition '%s' should be rejected." % (condition))
+
+
+def test_invalid_rule_rejected():
+
+    rule = {
+        "invalid": {
+            "condition": [
+                {"invalid": ">:ten"}
+            ],
+            "queue": [
+                {"invalid": {}}
+            ]
+        },
+        "valid": {
+            "condition": [
+                {"valid": "==:hello"}
+            ],
+            "queue": [
+                {"valid": {}}
+            ]
+        }
+    }
+
+    actor = generate_actor(rule)
+    e = Event({"invalid": "11", "valid": "hello"})
+    actor.pool.queue.inbox.put(e)
+    assert getter(actor.pool.queue.valid).get("@tmp.match.rule_file_name") == "valid"
+    try:
+        getter(actor.pool.queue.invalid)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("Invalid rule should not match.")
+
+
+def test_index_candidates():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+    rules = {
+        "one": {"condition": [{"host": "==:one"}, {"load": ">:1"}], "queue": [{"one": {}}]},
+        "two": {"condition": [{"host": "==:two"}], "queue": [{"two": {}}]},
+        "three": {"condition": [{"code": "=:3"}], "queue": [{"three": {}}]},
+        "four": {"condition": [{"host": "re:^t"}], "queue": [{"four": {}}]}
+    }
+
+    ruleset = RuleSet(rules, MatchRules())
+    assert list(ruleset.unindexed) == ["four"]
+
+    candidates = [r.name for r in ruleset.candidates(Evaluation(ruleset, Event({"host": "two", "code": "3.0"})))]
+    assert sorted(candidates) == ["four", "three", "two"]
+
+    candidates = [r.name for r in ruleset.candidates(Evaluation(ruleset, Event({"code": 4})), ignore_missing_fields=True)]
+    assert sorted(candidates) == ["four", "one", "two"]
+
+
+def test_index_routing():
+
+    rule = {
+        "equal_string": {"condition": [{"host": "==:one"}], "queue": [{"equal_string": {}}]},
+        "equal": {"condition": [{"code": "=:3"}, {"host": "==:one"}], "queue": [{"equal": {}}]}
+    }
+
+    actor = generate_actor(rule)
+    actor.pool.queue.inbox.put(Event({"host": "one", "code": 3}))
+    assert getter(actor.pool.queue.equal_string).get()["host"] == "one"
+    assert getter(actor.pool.queue.equal).get()["code"] == 3
+
+
+def test_regexset():
+
+    from wishbone_flow_match.matchrules import RegexSet
+
+    regexset = RegexSet(["t.o", "^one", "four$", r"(a)\1", "x{10}", "a|b"])
+    assert regexset.literals == {"t.o": "t", "^one": "one", "four$": "four", r"(a)\1": None, "x{10}": None, "a|b": None}
+    assert regexset.search("one two three") == set(["t.o", "^one"])
+    assert regexset.search("three four") == set(["four$"])
+    assert regexset.search("aa xxxxxxxxxx") == set([r"(a)\1", "x{10}", "a|b"])
+
+    regexset = RegexSet([r"\x41BC", r"\101BC", r"ab\)*c", r"\u0041x", "(?i)abc"])
+    assert regexset.literals == {r"\x41BC": "ABC", r"\101BC": "ABC", r"ab\)*c": "ab", r"\u0041x": "Ax", "(?i)abc": None}
+    assert regexset.search("abc") == set([r"ab\)*c", "(?i)abc"])
+    assert regexset.search("ABC") == set([r"\x41BC", r"\101BC", "(?i)abc"])
+
+    import random
+    rnd = random.Random(1)
+    atoms = ["a", "b", ".", r"\.", r"\)", r"\x61", r"\141", "[ab]", "(ab)", "(a|b)", r"\d", "1", "^", "$", "(?:bc)", "(?=a)", "(?i:b)", "|"]
+    quantifiers = ["", "", "*", "+", "?", "{2}", "{1,2}", "*?"]
+    patterns = set()
+    while len(patterns) < 300:
+        pattern = "".join([rnd.choice(atoms) + rnd.choice(quantifiers) for i in range(rnd.randint(1, 5))])
+        try:
+            re.compile(pattern)
+            patterns.add(pattern)
+        except re.error:
+            pass
+    regexset = RegexSet(sorted(patterns))
+    for i in range(300):
+        data = "".join([rnd.choice("abcB1.)") for i in range(rnd.randint(0, 8))])
+        assert regexset.search(data) == set([p for p in patterns if re.search(p, data)])
+
+
+def test_combined_regex():
+
+    rule = {
+        "regex": {"condition": [{"regex": "re:.*?two.*"}], "queue": [{"regex": {}}]},
+        "neg_regex": {"condition": [{"regex": "!re:four"}], "queue": [{"neg_regex": {}}]},
+        "backref": {"condition": [{"regex": r"re:(o)\1"}], "queue": [{"backref": {}}]},
+        "escaped": {"condition": [{"regex": r"re:fo\)*o"}], "queue": [{"escaped": {}}]}
+    }
+
+    actor = generate_actor(rule)
+    actor.pool.queue.inbox.put(Event({"regex": "one two three"}))
+    actor.pool.queue.inbox.put(Event({"regex": "foo"}))
+    assert getter(actor.pool.queue.regex).get()["regex"] == "one two three"
+    assert getter(actor.pool.queue.neg_regex).get()["regex"] == "one two three"
+    assert getter(actor.pool.queue.neg_regex).get()["regex"] == "foo"
+    assert getter(actor.pool.queue.backref).get()["regex"] == "foo"
+    assert getter(actor.pool.queue.escaped).get()["regex"] == "foo"
+
+
+def test_activate_new_rules():
+
+    rule = {"regex": {"condition": [{"regex": "re:two"}], "queue": [{"regex": {}}]}}
+
+    actor = generate_actor(rule)
+    ruleset = actor._Match__active_rules
+    actor.pool.createQueue("equal_string")
+    actor.pool.queue.equal_string.disableFallThrough()
+    actor.activateNewRules({"equal_string": {"condition": [{"regex": "==:one two"}], "queue": [{"equal_string": {}}]}})
+    assert actor._Match__active_rules is not ruleset
+    assert len(ruleset) == 1
+
+    actor.pool.queue.inbox.put(Event({"regex": "one two"}))
+    assert getter(actor.pool.queue.regex).get()["regex"] == "one two"
+    assert getter(actor.pool.queue.equal_string).get()["regex"] == "one two"
+
+
+def test_field_resolution():
+
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation, MISSING
+    from wishbone_flow_match.matchrules import MatchRules
+
+    evaluation = Evaluation(RuleSet({}, MatchRules()), Event({"one": {"two": {"three": 3}}, "list": [1]}))
+    assert evaluation.resolve("one.two.three", ("one", "two", "three")) == 3
+    assert evaluation.resolve("one.two.four", ("one", "two", "four")) is MISSING
+    assert evaluation.resolve("list.0", ("list", "0")) is MISSING
+    assert evaluation.fields["one.two.three"] == 3
+
+
+def test_copy_on_write():
+
+    from wishbone_flow_match.sharedevent import SharedEvent
+
+    original = Event({"one": {"two": 2}, "three": 3})
+    one = SharedEvent(original)
+    two = SharedEvent(original)
+    one.set("one", "@tmp.match.queue")
+    assert one.get() is original.get()
+    assert "match" not in original.get("@tmp")
+
+    one.set(4, "@data.three")
+    assert one.get("@data.three") == 4
+    assert two.get("@data.three") == 3
+    assert original.get("@data.three") == 3
+    assert two.get() is original.get()
+
+    two.delete("@data.three")
+    assert original.get("@data.three") == 3
+
+
+def test_copy_on_write_routing():
+
+    rule = {
+        "one": {"condition": [{"greeting": "re:hello"}], "queue": [{"one": {"x": 1}}]},
+        "two": {"condition": [{"greeting": "re:^hello$"}], "queue": [{"two": {"x": 2}}]}
+    }
+
+    actor = generate_actor(rule, copy_on_write=True)
+
+    original = Event({"greeting": "hello"})
+    actor.pool.queue.inbox.put(original)
+    one = getter(actor.pool.queue.one)
+    two = getter(actor.pool.queue.two)
+    assert one.get() is two.get()
+    assert one.get("@tmp.match.x") == 1
+    assert two.get("@tmp.match.x") == 2
+
+    original.set("mutated", "@data.greeting")
+    assert one.get() == {"greeting": "hello"}
+
+
+def test_batch_evaluation():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet
+    from wishbone_flow_match.batch import BatchEvaluation, bits
+
+    rules = {
+        "more": {"condition": [{"load": ">:5"}], "queue": [{"more": {}}]},
+        "equal": {"condition": [{"host": "==:one"}, {"load": "<=:10"}], "queue": [{"equal": {}}]},
+        "regex": {"condition": [{"host": "re:^t"}], "queue": [{"regex": {}}]},
+        "member": {"condition": [{"tags": "in:a"}], "queue": [{"member": {}}]}
+    }
+    events = [
+        Event({"host": "one", "load": 10, "tags": ["a"]}),
+        Event({"host": "two", "load": "x"}),
+        Event({"host": "three"}),
+        Event({"load": "6"})
+    ]
+
+    ruleset = RuleSet(rules, MatchRules())
+    batch = BatchEvaluation(ruleset, events)
+    result = dict([(r.name, sorted(bits(batch.evaluate(r)))) for r in ruleset.rules])
+    assert result == {"more": [0, 3], "equal": [0], "regex": [1, 2], "member": [0]}
+
+    batch = BatchEvaluation(ruleset, events, ignore_missing_fields=True)
+    result = dict([(r.name, sorted(bits(batch.evaluate(r)))) for r in ruleset.rules])
+    assert result == {"more": [0, 2, 3], "equal": [0, 3], "regex": [1, 2, 3], "member": [0, 1, 2, 3]}
+
+
+def test_batch_routing():
+
+    rule = {
+        "bigger": {"condition": [{"bigger": ">:10"}], "queue": [{"bigger": {}}]},
+        "regex": {"condition": [{"regex": "re:two"}], "queue": [{"regex": {}}]}
+    }
+
+    actor = generate_actor(rule, ["failed"], batch_size=10)
+
+    actor.pool.queue.inbox.put(Event({"bigger": "100", "regex": "one"}))
+    actor.pool.queue.inbox.put(Event("not a dict"))
+    actor.pool.queue.inbox.put(Event({"bigger": "1", "regex": "two"}))
+    assert getter(actor.pool.queue.bigger).get()["bigger"] == "100"
+    assert getter(actor.pool.queue.regex).get()["regex"] == "two"
+    assert getter(actor.pool.queue.failed).get() == "not a dict"
+
+
+def test_range_index():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+    rules = {
+        "more": {"condition": [{"load": ">:5"}], "queue": [{"more": {}}]},
+        "more_equal": {"condition": [{"load": ">=:10"}], "queue": [{"more_equal": {}}]},
+        "less": {"condition": [{"load": "<:10"}], "queue": [{"less": {}}]},
+        "less_equal": {"condition": [{"load": "<=:5"}], "queue": [{"less_equal": {}}]},
+        "latency": {"condition": [{"latency": "<:200"}], "queue": [{"latency": {}}]}
+    }
+
+    ruleset = RuleSet(rules, MatchRules())
+    assert len(ruleset.unindexed) == 0
+
+    def candidates(data):
+        return sorted([r.name for r in ruleset.candidates(Evaluation(ruleset, Event(data)))])
+
+    assert candidates({"load": "5"}) == ["less", "less_equal"]
+    assert candidates({"load": 10}) == ["more", "more_equal"]
+    assert candidates({"load": 7.5, "latency": 300}) == ["less", "more"]
+    assert candidates({"load": "nan", "latency": "x"}) == []
+
+
+def test_watcher():
+
+    import tempfile
+    import shutil
+    from gevent import spawn
+    from gevent import Timeout
+    from wishbone_flow_match.watchdir import InotifyWatcher, PollWatcher
+
+    directory = tempfile.mkdtemp()
+
+    def write(name):
+        sleep(0.2)
+        with open("%s/%s" % (directory, name), 'w') as f:
+            f.write("condition: []")
+
+    try:
+        for watcher in [InotifyWatcher(directory, debounce=0.05), PollWatcher(directory, interval=0.05)]:
+            spawn(write, "ignored.txt")
+            spawn(write, "%s.yaml" % (watcher.__class__.__name__))
+            with Timeout(2):
+                watcher.wait()
+            watcher.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_cache_not_watched():
+
+    import tempfile
+    import shutil
+    import yaml
+    from gevent import spawn
+    from gevent import Timeout
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrules import ReadRulesDisk
+
+    directory = tempfile.mkdtemp()
+
+    def write(name):
+        sleep(0.5)
+        with open("%s/%s.yaml" % (directory, name), 'w') as f:
+            f.write(yaml.dump({"condition": [{"host": "==:%s" % (name)}], "queue": [{name: {}}]}))
+
+    try:
+        write("one")
+        reader = ReadRulesDisk(Logging("test", Queue()), directory)
+        assert list(reader.getRules().keys()) == ["%s/one.yaml" % (directory)]
+        for name in ["two", "three"]:
+            spawn(write, name)
+            with Timeout(3):
+                changed, removed = reader.getChangesWait()
+            assert list(changed.keys()) == ["%s/%s.yaml" % (directory, name)]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_patch_ruleset():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+    rules = {
+        "one": {"condition": [{"host": "==:one"}], "queue": [{"one": {}}]},
+        "two": {"condition": [{"host": "==:two"}, {"check": "re:^a"}], "queue": [{"two": {}}]},
+        "three": {"condition": [{"load": ">:5"}, {"check": "re:^b"}], "queue": [{"three": {}}]},
+        "four": {"condition": [{"check": "re:c$"}], "queue": [{"four": {}}]}
+    }
+
+    def candidates(ruleset, data):
+        return sorted([r.name for r in ruleset.candidates(Evaluation(ruleset, Event(data)))])
+
+    old = RuleSet(rules, MatchRules())
+    new = old.patch({"two": {"condition": [{"host": "==:one"}], "queue": [{"two": {}}]},
+                     "five": {"condition": [{"load": "<:5"}], "queue": [{"five": {}}]}}, ["three", "four"])
+
+    assert sorted(r.name for r in old.rules) == ["four", "one", "three", "two"]
+    assert sorted(r.name for r in new.rules) == ["five", "one", "two"]
+    assert new.names["one"] is old.names["one"]
+    assert candidates(old, {"host": "one", "load": 10}) == ["four", "one", "three"]
+    assert candidates(new, {"host": "one", "load": 1}) == ["five", "one", "two"]
+    assert "load" not in new.ranges or new.ranges["load"] is not old.ranges["load"]
+    assert "check" in old.regexsets and "check" not in new.regexsets
+
+    def state(ruleset):
+        return (sorted(r.name for r in ruleset.rules),
+                sorted((name, sorted(r.name for r in rules)) for name, rules in ruleset.merged.items()),
+                sorted(ruleset.placement), sorted(ruleset.unindexed), ruleset.patterns)
+
+    rules = {
+        "a": {"condition": [{"x": "==:1"}], "queue": [{"a": {}}]},
+        "b": {"condition": [{"x": "==:1"}], "queue": [{"b": {}}]},
+        "c": {"condition": [{"check": "re:^a"}], "queue": [{"c": {}}]},
+        "d": {"condition": [{"check": "re:^a"}], "queue": [{"d": {}}]}
+    }
+    patches = [
+        ({"a": {"condition": [{"x": "==:1"}], "queue": [{"other": {}}]}}, []),
+        ({"b": {"condition": [{"x": "==:1"}], "queue": [{"other": {}}]}}, ["a"]),
+        ({"d": {"condition": [{"check": "re:^a"}], "queue": [{"other": {}}]}}, ["c"]),
+        ({"a": {"condition": [{"x": "==:2"}], "queue": [{"a": {}}]}, "e": {"condition": [{"x": "==:1"}], "queue": [{"e": {}}], "priority": 1}}, [])
+    ]
+    old = RuleSet(rules, MatchRules(), analyze=True)
+    for changed, removed in patches:
+        expected = dict(rules)
+        expected.update(changed)
+        for name in removed:
+            del(expected[name])
+        assert state(old.patch(changed, removed)) == state(RuleSet(expected, MatchRules(), analyze=True))
+
+
+def test_incremental_reload():
+
+    import tempfile
+    import shutil
+    import yaml
+    from gevent import Timeout
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrules import ReadRulesDisk
+
+    def write(name, value):
+        rule = {"condition": [{"file": "==:%s" % (value)}], "queue": [{"file": {}}]}
+        with open("%s/%s.yaml" % (directory, name), 'w') as f:
+            f.write(yaml.dump(rule, default_flow_style=False))
+
+    directory = tempfile.mkdtemp()
+    try:
+        write("one", "one")
+        write("two", "two")
+        reader = ReadRulesDisk(Logging("test", Queue()), directory)
+        assert len(reader.getRules()) == 2
+
+        write("two", "changed")
+        write("three", "three")
+        os.remove("%s/one.yaml" % (directory))
+        with Timeout(3):
+            changed, removed = reader.getChangesWait()
+        assert sorted(changed.keys()) == ["%s/three.yaml" % (directory), "%s/two.yaml" % (directory)]
+        assert removed == ["%s/one.yaml" % (directory)]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_rule_cache():
+
+    import tempfile
+    import shutil
+    import json
+    import yaml
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrules import ReadRulesDisk
+
+    directory = tempfile.mkdtemp()
+    try:
+        rule = {"condition": [{"file": "==:one"}], "queue": [{"file": {}}]}
+        with open("%s/one.yaml" % (directory), 'w') as f:
+            f.write(yaml.dump(rule, default_flow_style=False))
+        ReadRulesDisk(Logging("test", Queue()), directory).getRules()
+
+        cache_file = "%s/%s" % (directory, ReadRulesDisk.CACHE_FILE)
+        with open(cache_file) as f:
+            cache = json.load(f)
+        cache["files"]["%s/one.yaml" % (directory)]["rule"]["queue"] = [{"cached": {}}]
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+
+        rules = ReadRulesDisk(Logging("test", Queue()), directory).getRules()
+        assert rules["%s/one.yaml" % (directory)]["queue"] == [{"cached": {}}]
+
+        rules = ReadRulesDisk(Logging("test", Queue()), directory, cache=False).getRules()
+        assert rules["%s/one.yaml" % (directory)]["queue"] == [{"file": {}}]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_rule_metrics():
+
+    rule = {"regex": {"condition": [{"host": "==:one"}, {"regex": "re:two"}], "queue": [{"regex": {}}]}}
+
+    actor = generate_actor(rule, ["metrics", "regex"], rule_metrics=True, rule_metrics_sample=1)
+
+    actor.pool.queue.inbox.put(Event({"host": "one", "regex": "one two"}))
+    actor.pool.queue.inbox.put(Event({"host": "one", "regex": "three"}))
+    getter(actor.pool.queue.regex)
+    sleep(1.5)
+
+    metrics = dict(actor.rule_metrics.dump())
+    assert metrics["regex.evaluations"] == 2
+    assert metrics["regex.matches"] == 1
+    assert metrics["regex.sampled"] == 2
+    assert metrics["regex.condition.0.rejections"] == 0
+    assert metrics["regex.condition.1.evaluations"] == 2
+    assert metrics["regex.condition.1.rejections"] == 1
+    assert metrics["regex.regex_time"] > 0
+
+    names = []
+    for metric in actor.pool.queue.metrics.dump():
+        names.append(metric.get().name)
+    assert "module.match.rule.regex.matches" in names
+
+    from wishbone_flow_match.metrics import metricName
+    assert metricName("/etc/rules/web.frontend.yaml") == "web_frontend"
+    assert metricName("web.front end") == "web_front_end"
+
+
+def test_adaptive_ordering():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import Rule
+    from wishbone_flow_match.metrics import RuleMetrics
+
+    rule = Rule("rule", {"condition": [{"one": "re:expensive"}, {"two": "==:cheap"}], "queue": []}, MatchRules())
+    metrics = RuleMetrics(sample=1)
+    assert metrics.order(rule) is None
+
+    for i in range(100):
+        metrics.record(rule, 1, [0.002, 0.0001])
+        metrics.record(rule, None, [0.002, 0.0001])
+        metrics.record(rule, 0, [0.002])
+    assert metrics.order(rule, minimum=1000) is None
+
+    conditions = metrics.order(rule)
+    assert [c.field for c in conditions] == ["two", "one"]
+    rule.conditions = conditions
+    assert metrics.order(rule) is None
+
+    metrics.record(rule, None, [0.0001, 0.002])
+    dumped = dict(metrics.dump())
+    assert dumped["rule.evaluations"] == 301
+    assert dumped["rule.matches"] == 101
+    assert dumped["rule.condition.0.evaluations"] == 1
+
+
+def test_first_match():
+
+    rule = {
+        "low": {"condition": [{"greeting": "re:hello"}], "queue": [{"low": {}}], "priority": 1},
+        "high": {"condition": [{"greeting": "==:hello"}], "queue": [{"high": {}}], "priority": 10},
+        "none": {"condition": [{"greeting": "re:^h"}], "queue": [{"none": {}}]}
+    }
+
+    for batch_size in [0, 10]:
+        actor = generate_actor(rule, first_match=True, batch_size=batch_size)
+
+        actor.pool.queue.inbox.put(Event({"greeting": "hello"}))
+        actor.pool.queue.inbox.put(Event({"greeting": "hello there"}))
+        actor.pool.queue.inbox.put(Event({"greeting": "hi"}))
+        assert getter(actor.pool.queue.high).get()["greeting"] == "hello"
+        assert getter(actor.pool.queue.low).get()["greeting"] == "hello there"
+        assert getter(actor.pool.queue.none).get()["greeting"] == "hi"
+        assert actor.pool.queue.low.size() == 0
+        assert actor.pool.queue.none.size() == 0
+        actor.stop()
+
+
+def test_worker_routing():
+
+    rule = {
+        "bigger": {"condition": [{"bigger": ">:10"}], "queue": [{"bigger": {}}]},
+        "regex": {"condition": [{"nested.regex": "re:two"}], "queue": [{"regex": {}}]}
+    }
+
+    actor = generate_actor(rule, ["failed"], batch_size=10, workers=2, order_by="host")
+
+    for number in range(20):
+        actor.pool.queue.inbox.put(Event({"host": number % 3, "bigger": str(number + 11)}))
+    actor.pool.queue.inbox.put(Event("not a dict"))
+    actor.pool.queue.inbox.put(Event({"host": 1, "nested": {"regex": "two"}}))
+
+    received = [getter(actor.pool.queue.bigger).get() for number in range(20)]
+    for host in range(3):
+        bigger = [int(data["bigger"]) for data in received if data["host"] == host]
+        assert bigger == sorted(bigger)
+    assert getter(actor.pool.queue.regex).get()["nested"]["regex"] == "two"
+    assert getter(actor.pool.queue.failed).get() == "not a dict"
+    actor.stop()
+
+
+def test_match_cache():
+
+    rule = {
+        "bigger": {"condition": [{"bigger": ">:10"}], "queue": [{"bigger": {}}]},
+        "tags": {"condition": [{"tags": "in:one"}], "queue": [{"tags": {}}]}
+    }
+
+    actor = generate_actor(rule, match_cache=2)
+
+    for value in ["100", "100", 100, "1", "100"]:
+        actor.pool.queue.inbox.put(Event({"bigger": value}))
+    assert [getter(actor.pool.queue.bigger).get()["bigger"] for number in range(4)] == ["100", "100", 100, "100"]
+    assert (actor.match_cache.hits, actor.match_cache.misses, actor.match_cache.evictions) == (1, 4, 2)
+
+    actor.pool.queue.inbox.put(Event({"bigger": "100", "tags": ["one"]}))
+    assert getter(actor.pool.queue.tags).get()["tags"] == ["one"]
+    assert actor.match_cache.skipped == 1
+
+    actor.activateNewRules({})
+    assert len(actor.match_cache.results) == 0
+
+
+def test_single_nomatch():
+
+    rule = {
+        "one": {"condition": [{"greeting": "==:hello"}], "queue": [{"outbox": {"rule": "one"}}]},
+        "two": {"condition": [{"greeting": "re:^hel"}], "queue": [{"outbox": {"rule": "two"}}, {"outbox": {}}], "priority": 1},
+        "three": {"condition": [{"other": "==:hello"}], "queue": [{"outbox": {}}]}
+    }
+
+    actor = generate_actor(rule, ["nomatch", "outbox"], collapse_queues=True)
+
+    actor.pool.queue.inbox.put(Event({"greeting": "goodbye"}))
+    actor.pool.queue.inbox.put(Event({"greeting": "hello"}))
+    assert getter(actor.pool.queue.nomatch).get()["greeting"] == "goodbye"
+    assert getter(actor.pool.queue.outbox).get("@tmp.match.rule") == "two"
+    sleep(0.5)
+    assert actor.pool.queue.nomatch.size() == 0
+    assert actor.pool.queue.outbox.size() == 0
+
+
+def test_anyof():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+    rules = {
+        "anyof": {"condition": [{"host": "anyof:db01,db02,3"}], "queue": [{"anyof": {}}]},
+        "not_anyof": {"condition": [{"host": "!anyof:db01,db02"}], "queue": [{"not_anyof": {}}]}
+    }
+    ruleset = RuleSet(rules, MatchRules())
+    assert list(ruleset.unindexed.keys()) == ["not_anyof"]
+
+    def matches(data):
+        evaluation = Evaluation(ruleset, Event(data))
+        candidates = ruleset.candidates(evaluation)
+        assert len(candidates) == len(set(candidates))
+        return sorted([rule.name for rule in candidates if rule.conditions[0].operator(evaluation.resolve("host", ("host",)))])
+
+    assert matches({"host": "db02"}) == ["anyof"]
+    assert matches({"host": 3}) == ["anyof", "not_anyof"]
+    assert matches({"host": "web01"}) == ["not_anyof"]
+    assert matches({"host": ["web01", "db01", "db02"]}) == ["anyof"]
+    assert matches({"host": ["web01"]}) == ["not_anyof"]
+
+
+def test_anyof_file_reload():
+
+    import tempfile
+    import shutil
+    import yaml
+    from gevent import Timeout
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet
+    from wishbone_flow_match.readrules import ReadRulesDisk
+
+    directory = tempfile.mkdtemp()
+    try:
+        with open("%s/hosts.txt" % (directory), 'w') as f:
+            f.write("# databases\ndb01\n\ndb02\n")
+        rule = {"condition": [{"host": "anyof:@hosts.txt"}], "queue": [{"database": {}}]}
+        with open("%s/database.yaml" % (directory), 'w') as f:
+            f.write(yaml.dump(rule, default_flow_style=False))
+
+        match = MatchRules(directory)
+        reader = ReadRulesDisk(Logging("test", Queue()), directory)
+        ruleset = RuleSet(reader.getRules(), match)
+        assert ruleset.rules[0].conditions[0].operator.value == frozenset(["db01", "db02"])
+
+        with open("%s/hosts.txt" % (directory), 'w') as f:
+            f.write("db01\ndb02\ndb03\n")
+        with Timeout(3):
+            changed, removed = reader.getChangesWait()
+        assert list(changed.keys()) == ["%s/database.yaml" % (directory)]
+        ruleset = ruleset.patch(changed, removed)
+        assert ruleset.rules[0].conditions[0].operator.value == frozenset(["db01", "db02", "db03"])
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_analyze_rules():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+
+    rules = {
+        "one": {"condition": [{"host": "==:db01"}, {"load": ">:10"}], "queue": [{"one": {}}]},
+        "two": {"condition": [{"load": ">:10"}, {"host": "==:db01"}], "queue": [{"two": {}}], "priority": 1},
+        "three": {"condition": [{"host": "==:db01"}], "queue": [{"three": {}}]},
+        "range": {"condition": [{"load": "=:5"}, {"load": ">:10"}], "queue": [{"range": {}}]},
+        "strings": {"condition": [{"host": "==:db01"}, {"host": "!==:db01"}], "queue": [{"strings": {}}]}
+    }
+
+    ruleset = RuleSet(rules, MatchRules(), analyze=True)
+    assert sorted(ruleset.rejected.keys()) == ["range", "strings"]
+    assert sorted([rule.name for rule in ruleset.rules]) == ["three", "two"]
+    assert [rule.name for rule in ruleset.merged["two"]] == ["one"]
+    assert "two" in ruleset.findings["one"]
+    assert "three" in ruleset.findings["two"]
+
+    evaluation = Evaluation(ruleset, Event({"host": "db01", "load": 20}))
+    candidates = ruleset.candidates(evaluation)
+    assert sorted([rule.name for rule in ruleset.expand(candidates)]) == ["one", "three", "two"]
+
+    ruleset = ruleset.patch({}, ["two"])
+    assert sorted([rule.name for rule in ruleset.rules]) == ["one", "three"]
+    assert ruleset.merged == {}
+    evaluation = Evaluation(ruleset, Event({"host": "db01", "load": 20}))
+    assert sorted([rule.name for rule in ruleset.expand(ruleset.candidates(evaluation))]) == ["one", "three"]
+
+    ruleset = ruleset.patch({"four": {"condition": [{"load": ">:10"}], "queue": [{"four": {}}]},
+                             "five": {"condition": [{"host": "==:db01"}, {"load": ">:10"}, {"check": "re:^a"}], "queue": [{"five": {}}]}}, [])
+    assert ruleset.findings == {"one": "Matches a subset of the events matched by rule 'four'.",
+                                "five": "Matches a subset of the events matched by rule 'three'."}
+    assert ruleset.containing[("load", ">:10")] == set([(("host", "==:db01"), ("load", ">:10")), (("load", ">:10"),), (("check", "re:^a"), ("host", "==:db01"), ("load", ">:10"))])
+
+    ruleset = RuleSet(rules, MatchRules(), analyze=True, keep_unsatisfiable=True)
+    assert ruleset.rejected == {}
+    assert "missing" in ruleset.findings["range"]
+
+
+def test_prebuilt_headers():
+
+    rule = {"regex": {
+        "condition": [{"regex": "re:two"}],
+        "queue": [{"regex": {"one": 1, "queue": "overwritten"}}]
+    }}
+
+    actor = generate_actor(rule, ["regex"], shared_headers=True)
+
+    actor.pool.queue.inbox.put(Event({"regex": "one two"}))
+    actor.pool.queue.inbox.put(Event({"regex": "two three"}))
+    one = getter(actor.pool.queue.regex)
+    two = getter(actor.pool.queue.regex)
+    assert one.get("@tmp.match") == {"rule_file_name": "regex", "condition": [{"regex": "re:two"}], "one": 1, "queue": "regex"}
+    assert one.get("@tmp.match") is two.get("@tmp.match")
+
+
+def test_decision_tree():
+
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+    from wishbone_flow_match.tree import DecisionTree, test
+
+    rules = {}
+    for number in range(20):
+        rules["rule%s" % (number)] = {"condition": [{"environment": "==:production"}, {"load": ">:%s" % (number)}, {"host": "re:^db"}], "queue": [{"outbox": {}}]}
+    rules["other"] = {"condition": [{"environment": "!==:production"}], "queue": [{"outbox": {}}]}
+    rules["always"] = {"condition": [], "queue": [{"outbox": {}}]}
+    ruleset = RuleSet(rules, MatchRules())
+
+    events = [{"environment": "production", "load": 5, "host": "db01"},
+              {"environment": "production", "load": "x", "host": "db01"},
+              {"environment": "test", "load": 50, "host": "web01"},
+              {"host": "db01", "load": 15}]
+
+    for ignore_missing_fields in [False, True]:
+        tree = DecisionTree(ruleset, ignore_missing_fields)
+        for data in events:
+            evaluation = Evaluation(ruleset, Event(data))
+            expected = [rule.name for rule in ruleset.rules if all([test(c, evaluation, ignore_missing_fields) for c in rule.conditions])]
+            assert sorted([rule.name for rule in tree.match(evaluation)]) == sorted(expected)
+        assert tree.tests <= len(events) * 23
+    assert tree.nodes <= 2 * sum([len(rule.conditions) + 1 for rule in ruleset.rules])
+
+    actor = generate_actor(rules, ["outbox"], engine="tree")
+    actor.pool.queue.inbox.put(Event(events[0]))
+    assert sorted([getter(actor.pool.queue.outbox).get("@tmp.match.rule_file_name") for number in range(6)]) == ["always", "rule0", "rule1", "rule2", "rule3", "rule4"]
+
+
+def test_codegen():
+
+    import random
+    from wishbone_flow_match.matchrules import MatchRules
+    from wishbone_flow_match.ruleset import RuleSet, Evaluation
+    from wishbone_flow_match.tree import test
+    from wishbone_flow_match.codegen import CodeGen
+
+    conditions = ["==:db01", "!==:db01", "re:^db", "!re:^db", ">:5", ">=:5", "<:5", "<=:5", "=:5", "!=:5", "in:db01", "!in:db01", "anyof:db01,5", "!anyof:db01,5"]
+    values = ["db01", "db02", 5, "5", 4.5, "x", ["db01"], ["web01"], {"a": 1}, None, True]
+    fields = ["host", "nested.host", "load"]
+
+    rnd = random.Random(1)
+    rules = {}
+    for number in range(60):
+        condition = [{field: rnd.choice(conditions)} for field in rnd.sample(fields, rnd.randint(0, 3))]
+        rules["rule%s" % (number)] = {"condition": condition, "queue": [{"outbox": {}}]}
+    ruleset = RuleSet(rules, MatchRules())
+
+    for ignore_missing_fields in [False, True]:
+        codegen = CodeGen(ruleset, ignore_missing_fields)
+        for number in range(200):
+            data = {}
+            for field in rnd.sample(fields, rnd.randint(0, 3)):
+                if field == "nested.host":
+                    data["nested"] = rnd.choice([{"host": rnd.choice(values)}, "not a dict"])
+                else:
+                    data[field] = rnd.choice(values)
+            evaluation = Evaluation(ruleset, Event(data))
+            expected = [rule.name for rule in ruleset.rules if all([test(c, evaluation, ignore_missing_fields) for c in rule.conditions])]
+            assert sorted([rule.name for rule in codegen.match(evaluation)]) == sorted(expected)
+    assert "def match(data):" in codegen.source
+
+    rules = {"one": {"condition": [{"host": "==:db01"}], "queue": []}, "two": {"condition": [{"host": "==:db01"}], "queue": []}}
+    source = CodeGen(RuleSet(rules, MatchRules()), False).source
+    assert "    matched.append(R[0])\n    matched.append(R[1])\n" in source
+
+    # Compiling 4 times as many rules takes about 4 times as long.
+    import time
+    timings = []
+    for count in [1000, 4000]:
+        rules = dict([("rule%s" % (number), {"condition": [{"host%s" % (number % 10): "==:db%s" % (rnd.randint(0, 1000))}, {"load": ">:%s" % (number)}, {"check": "re:^c%s" % (number)}], "queue": []}) for number in range(count)])
+        ruleset = RuleSet(rules, MatchRules(), combine_regex=False)
+        start = time.time()
+        CodeGen(ruleset)
+        timings.append(time.time() - start)
+    assert timings[1] < timings[0] * 8
+
+    actor = generate_actor({"one": {"condition": [{"host": "==:db01"}, {"load": ">:5"}], "queue": [{"outbox": {}}]}}, ["outbox"], engine="codegen", verify_engine=True)
+    actor.pool.queue.inbox.put(Event({"host": "db01", "load": "10"}))
+    assert getter(actor.pool.queue.outbox).get()["load"] == "10"
+
+
+def test_threaded_reload():
+
+    import tempfile
+    import shutil
+    import yaml
+    from gevent import spawn
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrules import ReadRulesDisk
+
+    directory = tempfile.mkdtemp()
+    try:
+        for number in range(500):
+            rule = {"condition": [{"host": "==:host%s" % (number)}], "queue": [{"host%s" % (number): {}}]}
+            with open("%s/host%s.yaml" % (directory, number), 'w') as f:
+                f.write(yaml.dump(rule, default_flow_style=False))
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(None)
+                sleep(0)
+
+        ticker = spawn(tick)
+        sleep(0)
+        before = len(ticks)
+        reader = ReadRulesDisk(Logging("test", Queue()), directory, cache=False)
+        rules = reader.getRules()
+        ticker.kill()
+        assert len(rules) == 500
+        assert len(ticks) > before
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_bulk_file_rules():
+
+    import tempfile
+    import shutil
+    import json
+    from gevent import Timeout
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrulesbulk import ReadRulesFile
+
+    directory = tempfile.mkdtemp()
+    try:
+        with open("%s/rules.yaml" % (directory), 'w') as f:
+            f.write("---\nname: one\ncondition:\n  - host: ==:db01\nqueue:\n  - one: {}\n---\nname: two\ncondition:\n  - host: ==:db02\nqueue:\n  - two: {}\n")
+        reader = ReadRulesFile(Logging("test", Queue()), "%s/rules.yaml" % (directory))
+        assert reader.getRules() == {"one": {"condition": [{"host": "==:db01"}], "queue": [{"one": {}}]},
+                                     "two": {"condition": [{"host": "==:db02"}], "queue": [{"two": {}}]}}
+
+        rules = [{"name": "one", "condition": [{"host": "==:db01"}], "queue": [{"one": {}}]},
+                 {"name": "two", "condition": [{"host": "==:db02"}], "queue": [{"two": {}}]}]
+        with open("%s/rules.jsonl" % (directory), 'w') as f:
+            f.write("\n".join([json.dumps(rule) for rule in rules]) + "\n")
+        reader = ReadRulesFile(Logging("test", Queue()), "%s/rules.jsonl" % (directory))
+        assert sorted(reader.getRules().keys()) == ["one", "two"]
+
+        rules[1]["condition"] = [{"host": "==:db03"}]
+        rules.append({"name": "three", "condition": [{"host": "==:db04"}], "queue": [{"three": {}}]})
+        with open("%s/rules.jsonl" % (directory), 'w') as f:
+            f.write("\n".join([json.dumps(rule) for rule in rules[1:]]) + "\n")
+        with Timeout(3):
+            changed, removed = reader.getChangesWait()
+        assert sorted(changed.keys()) == ["three", "two"]
+        assert changed["two"]["condition"] == [{"host": "==:db03"}]
+        assert removed == ["one"]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_sqlite_rules():
+
+    import tempfile
+    import shutil
+    import json
+    import sqlite3
+    from gevent import Timeout
+    from wishbone.logging import Logging
+    from wishbone.queue import Queue
+    from wishbone_flow_match.readrulesbulk import ReadRulesSQLite
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = "%s/rules.db" % (directory)
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE rules (name TEXT PRIMARY KEY, rule TEXT, version INTEGER)")
+        for version, name in enumerate(["one", "two", "three"], 1):
+            rule = {"condition": [{"host": "==:%s" % (name)}], "queue": [{name: {}}]}
+            connection.execute("INSERT INTO rules VALUES (?, ?, ?)", (name, json.dumps(rule), version))
+        connection.execute("INSERT INTO rules VALUES (?, ?, ?)", ("broken", "condition: [", 3))
+        connection.execute("INSERT INTO rules VALUES (?, ?, ?)", ("null", None, None))
+        connection.execute("INSERT INTO rules VALUES (?, ?, ?)", ("blob", b"condition: []", 3))
+        connection.commit()
+
+        reader = ReadRulesSQLite(Logging("test", Queue()), filename, interval=0.1)
+        rules = reader.getRules()
+        assert sorted(rules.keys()) == ["one", "three", "two"]
+        assert rules["one"] == {"condition": [{"host": "==:one"}], "queue": [{"one": {}}]}
+
+        connection.execute("UPDATE rules SET rule = ?, version = 4 WHERE name = 'two'", ("condition:\n  - host: ==:db02\nqueue:\n  - two: {}\n",))
+        connection.execute("DELETE FROM rules WHERE name = 'one'")
+        connection.commit()
+        with Timeout(3):
+            changed, removed = reader.getChangesWait()
+        assert changed == {"two": {"condition": [{"host": "==:db02"}], "queue": [{"two": {}}]}}
+        assert removed == ["one"]
+
+        connection.execute("UPDATE rules SET rule = NULL, version = 5 WHERE name = 'three'")
+        connection.commit()
+        with Timeout(3):
+            changed, removed = reader.getChangesWait()
+        assert changed == {}
+        assert removed == ["three"]
+        connection.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_worker_respawn():
+
+    rule = {
+        "bigger": {"condition": [{"bigger": ">:10"}], "queue": [{"bigger": {}}]}
+    }
+
+    actor = generate_actor(rule, ["failed"], batch_size=10, workers=1)
+
+    actor.pool.queue.inbox.put(Event({"bigger": 11}))
+    assert getter(actor.pool.queue.bigger).get() == {"bigger": 11}
+
+    # Stop the worker so the next batch stays in flight when it is killed.
+    process = actor.workers.processes[0]
+    os.kill(process.pid, signal.SIGSTOP)
+    actor.pool.queue.inbox.put(Event({"bigger": 12}))
+    sleep(0.5)
+    assert len(actor.workers.pending[0]) == 1
+    os.kill(process.pid, signal.SIGKILL)
+    assert getter(actor.pool.queue.failed).get() == {"bigger": 12}
+
+    actor.pool.queue.inbox.put(Event({"bigger": 13}))
+    assert getter(actor.pool.queue.bigger).get() == {"bigger": 13}
+    assert actor.workers.processes[0] is not process
+    actor.stop()
@@ -24,10 +24,26 @@
 
 
 from wishbone import Actor
+from wishbone.error import QueueEmpty
+from wishbone.event import Event, Metric
 from gevent import sleep
+from gevent import socket
+from gevent import get_hub
+from time import time
+from sys import exc_info
+import traceback
+import os
 from .matchrules import MatchRules
 from .readrules import ReadRulesDisk
-from gevent.lock import Semaphore
+from .readrulesbulk import ReadRulesFile, ReadRulesSQLite
+from .ruleset import RuleSet, Evaluation, MISSING
+from .sharedevent import SharedEvent
+from .batch import BatchEvaluation, bits
+from .metrics import RuleMetrics
+from .workers import WorkerPool
+from .matchcache import MatchCache
+from .tree import DecisionTree
+from .codegen import CodeGen
 
 
 class Match(Actor):
@@ -62,6 +78,10 @@ class Match(Actor):
         !=:     Not equal to (numeral only)
         in:     Check whether element is in list
         !in:    Check whether element is not in list
+        anyof:  Check whether the value, or an element of the list, is one of
+                the comma separated values or the values in @<filename>
+        !anyof: Check whether the value, or no element of the list, is one
+                of the comma separated values or the values in @<filename>
 
 
     - queue:
@@ -77,6 +97,20 @@ class Match(Actor):
     rule matches, evaluation the other rules will continue untill all rules
     are processed.
 
+    When <first_match> is enabled, rules are evaluated in order of their
+    optional *priority* (an integer, default 0) from high to low and rules
+    with the same priority in order of their name.  Evaluation stops at the
+    first matching rule.
+
+    Rules are compiled when they are loaded.  A rule containing an invalid
+    condition is rejected at that moment and logged.
+
+    Rules containing a ==: or =: condition are indexed on the required value.
+    Such a rule is only evaluated when the event carries that value, which
+    keeps the cost per event related to the number of relevant rules instead
+    of the total number of rules.  Likewise, rules containing a >:, >=:, <:
+    or <=: condition are indexed on the boundary of that range.
+
     *Examples*
 
     This example would route the events - with field "greeting" containing
@@ -93,6 +127,21 @@ class Match(Actor):
 
 
 
+    This example is evaluated before rules with a lower priority when
+    <first_match> is enabled.
+
+    ::
+
+        condition:
+            - hostname: ==:db01
+
+        queue:
+            - database:
+
+        priority: 10
+
+
+
     This example combines multiple conditions and stores 4 variables under
     @tmp.<self.name> while submitting the event to the modules'
     **email** queue.
@@ -113,6 +162,20 @@ class Match(Actor):
                 template: host_email_alert
 
 
+    This example matches a host being one of the hostnames listed in the
+    file databases.txt, one per line, stored in the rules directory.  The
+    rule is compiled again when that file changes.
+
+    ::
+
+        condition:
+            - hostname: anyof:@databases.txt
+
+        queue:
+            - database:
+
+
+
     Field names can refer to nested dictionaries using a dot notation.
 
 
@@ -130,6 +193,41 @@ class Match(Actor):
         - location(str)("")
            |  The directory containing rules.
            |  If empty, no rules are read from disk.
+           |  A file ending in .jsonl or .json is read as one JSON rule
+           |  per line and a file ending in .yaml or .yml as multiple YAML
+           |  rule documents.  "sqlite:<file>" reads the rules from the
+           |  "rules" table of a SQLite database.  Each rule of these
+           |  sources needs a "name" key.  Value files are looked up in the
+           |  directory of the file.
+
+        - rule_cache(bool)(True)
+           |  Keeps the parsed rules of <location> in a sidecar cache file
+           |  so only new and changed rule files are parsed at startup.
+           |  Only applies when <location> is a directory.
+
+        - rule_metrics(bool)(False)
+           |  Submits per rule and per condition evaluation metrics to the
+           |  metrics queue every <frequency> seconds.  A rule read from a
+           |  file is named after the file without directory and extension
+           |  in the metric name, and characters other than letters, digits,
+           |  "_" and "-" are replaced by "_".
+
+        - rule_metrics_sample(int)(100)
+           |  Measures the evaluation time of one in this many rule
+           |  evaluations when <rule_metrics> is enabled.
+
+        - adaptive_ordering(bool)(False)
+           |  Measures the cost and rejection rate of each condition and
+           |  periodically reorders the conditions of each rule so the
+           |  cheapest and most selective ones are evaluated first.  This
+           |  does not change the outcome since all conditions have to match.
+
+        - adaptive_interval(int)(60)
+           |  The number of seconds between 2 reorderings.
+
+        - first_match(bool)(False)
+           |  Stops evaluating at the first matching rule.  Rules are
+           |  evaluated in order of their priority.
 
         - rules(dict)({})
            |  A dict of rules in the above described format.
@@ -144,6 +242,102 @@ class Match(Actor):
         - log_matches(boot)(False)
            |  Logs the matching logic. Optional because can cause many events/traffic.
 
+        - combine_regex(bool)(True)
+           |  Combines the re: and !re: patterns of all rules sharing a field
+           |  into a set searched once per event.  Only the patterns of which
+           |  the literal text every match requires occurs in the field value
+           |  are run.  Patterns without such a literal, such as the ones
+           |  containing top level alternations, are always run.
+
+        - copy_on_write(bool)(False)
+           |  Submitted events share the '@data' payload of the incoming event
+           |  instead of getting a copy each.  Only the header is private.
+           |  The incoming event itself gets a single private copy since it
+           |  continues to the success queue.
+           |  The payload is copied when a downstream module modifies it
+           |  using set(), delete() or copy().  Downstream modules must not
+           |  modify the value returned by get() in place.
+
+        - batch_size(int)(0)
+           |  When bigger than 0, events are consumed in batches of up to
+           |  this many events.  The conditions are evaluated over all events
+           |  of the batch at once, using NumPy when it is installed.
+           |  When 0 (default), events are consumed one by one.
+
+        - batch_timeout(float)(0.01)
+           |  The max number of seconds to wait for a batch to fill up.
+
+        - analyze_rules(bool)(False)
+           |  Analyzes the rules when they are loaded.  Rules having the
+           |  same conditions are evaluated once and route to the queues of
+           |  all of them.  Rules which can never match, such as the ones
+           |  requiring a field to be =:5 and >:10, are rejected unless
+           |  <ignore_missing_fields> is enabled.  Rules matching a subset
+           |  of the events of another rule are reported.  The findings are
+           |  logged.
+
+        - shared_headers(bool)(False)
+           |  The values stored under @tmp.<name> of a routed event are
+           |  built once when a rule is loaded.  By default each event gets
+           |  a copy.  When enabled, all events routed to the same queue by
+           |  the same rule share them.  Downstream modules must not modify
+           |  them in that case.
+
+        - collapse_queues(bool)(False)
+           |  When multiple matching rules route to the same queue, or a
+           |  rule lists a queue more than once, the event is submitted to
+           |  that queue only once.  The rule with the highest priority, and
+           |  then the lowest name, determines the header.
+
+        - engine(str)("index")
+           |  The engine evaluating the rules of events consumed one by one.
+           |  "index" evaluates the rules found using the indexes one by
+           |  one.  "tree" compiles all rules into a decision tree in which
+           |  each distinct condition is tested at most once per event,
+           |  which pays off when many rules share conditions.  The tree is
+           |  rebuilt whenever rules change.  Its size and the average
+           |  number of tests per event are submitted to the metrics queue
+           |  every <frequency> seconds.  <rule_metrics> and
+           |  <adaptive_ordering> only apply to the "index" engine.
+           |  "codegen" compiles all rules into a Python function with the
+           |  field lookups and conversions done once and the conditions
+           |  inlined.
+
+        - verify_engine(bool)(False)
+           |  Evaluates each event using the "index" engine as well and
+           |  logs an error when the result differs from the one of
+           |  <engine>.  Meant for testing only.
+
+        - engine_source(str)("")
+           |  The file to write the source generated by the "codegen"
+           |  engine to whenever rules change.
+
+        - match_cache(int)(0)
+           |  When bigger than 0, the matching rules of up to this many
+           |  distinct combinations of the values of the fields referenced by
+           |  the rules are remembered so repeating events skip evaluation.
+           |  The cache is cleared when new rules are activated.  Its hit,
+           |  miss and eviction counters are submitted to the metrics queue
+           |  every <frequency> seconds.  Only applies to events consumed
+           |  one by one.
+
+        - workers(int)(0)
+           |  When bigger than 0, the rules are evaluated by this many
+           |  worker processes.  Each worker compiles the rules on every
+           |  reload.  Batches of events, formed using <batch_size> and
+           |  <batch_timeout>, are sent to the workers.  Only the fields
+           |  referenced by the rules are sent.  Routing and submitting
+           |  happens in this process.  <rule_metrics>, <adaptive_ordering>
+           |  and <log_matches> do not apply to the evaluation in workers.
+           |  A worker which dies is replaced and the events it was
+           |  evaluating are submitted to the failed queue.
+
+        - order_by(str)("")
+           |  When <workers> is enabled, the events with the same value for
+           |  this field are always evaluated by the same worker so they
+           |  leave in the order they arrived.  When empty, batches are
+           |  distributed round robin and the order of events is not kept.
+
     Queues:
 
         - inbox
@@ -153,38 +347,178 @@ class Match(Actor):
            |  The queue which matches a rule
 
         - nomatch
-           |  The queue receiving event without matches
+           |  The queue receiving the events which did not match any rule
 
     '''
 
-    def __init__(self, actor_config, location="", rules={}, ignore_missing_fields=False, log_matches=False):
+    def __init__(self, actor_config, location="", rules={}, ignore_missing_fields=False, log_matches=False, combine_regex=True, copy_on_write=False, batch_size=0, batch_timeout=0.01, rule_cache=True, rule_metrics=False, rule_metrics_sample=100, adaptive_ordering=False, adaptive_interval=60, first_match=False, workers=0, order_by="", match_cache=0, collapse_queues=False, analyze_rules=False, shared_headers=False, engine="index", verify_engine=False, engine_source=""):
         Actor.__init__(self, actor_config)
 
         self.pool.createQueue("inbox")
         self.pool.createQueue("nomatch")
-        self.registerConsumer(self.consume, "inbox")
-
-        self.__active_rules = {}
-        self.match = MatchRules()
-        self.rule_lock = Semaphore()
+        if self.kwargs.batch_size == 0 and self.kwargs.workers == 0:
+            self.registerConsumer(self.consume, "inbox")
+
+        self.match = MatchRules(self.valueDirectory())
+        self.__active_rules = RuleSet({}, self.match)
+        if self.kwargs.engine not in ("index", "tree", "codegen"):
+            raise Exception("Engine '%s' is not supported." % (self.kwargs.engine))
+        self.__engine = None
+        if self.kwargs.rule_metrics or self.kwargs.adaptive_ordering:
+            self.rule_metrics = RuleMetrics(self.kwargs.rule_metrics_sample)
+        else:
+            self.rule_metrics = None
+        self.workers = None
+        if self.kwargs.match_cache > 0:
+            self.match_cache = MatchCache(self.kwargs.match_cache)
+        else:
+            self.match_cache = None
 
     def preHook(self):
+        if self.kwargs.workers > 0:
+            self.workers = WorkerPool(self.kwargs.workers,
+                                      self.kwargs.order_by,
+                                      self.kwargs.combine_regex,
+                                      self.kwargs.ignore_missing_fields,
+                                      self.kwargs.first_match,
+                                      self.valueDirectory(),
+                                      self.kwargs.analyze_rules)
+
         if self.kwargs.location == "":
-            self.__active_rules.update(self.uplook.dump()["rules"])
+            self.activateNewRules({})
             self.logging.info("No rules directory defined, not reading rules from disk.")
         else:
-            self.read_rules_disk = ReadRulesDisk(self.logging, self.kwargs.location)
+            self.read_rules_disk = self.createRuleReader()
             disk_rules = self.read_rules_disk.getRules()
             self.activateNewRules(disk_rules)
             self.sendToBackground(self.monitorRuleDirectory)
 
+        if self.workers is not None:
+            self.sendToBackground(self.consumeWorkers)
+            for worker in range(self.kwargs.workers):
+                self.sendToBackground(self.consumeWorkerResults, worker)
+        elif self.kwargs.batch_size > 0:
+            self.sendToBackground(self.consumeBatch)
+
+        if self.kwargs.rule_metrics:
+            self.sendToBackground(self.ruleMetricProducer)
+
+        if self.kwargs.adaptive_ordering:
+            self.sendToBackground(self.reorderConditions)
+
+        if self.match_cache is not None:
+            self.sendToBackground(self.matchCacheMetricProducer)
+
+        if self.kwargs.engine != "index":
+            self.sendToBackground(self.engineMetricProducer)
+
+    def createRuleReader(self):
+        '''Returns the reader of the rules stored in <location>.'''
+
+        location = self.kwargs.location
+        if location.startswith("sqlite:"):
+            return ReadRulesSQLite(self.logging, location[len("sqlite:"):])
+        elif os.path.splitext(location)[1] in ReadRulesFile.EXTENSIONS:
+            return ReadRulesFile(self.logging, location)
+        else:
+            return ReadRulesDisk(self.logging, location, self.kwargs.rule_cache)
+
+    def valueDirectory(self):
+        '''Returns the directory containing the value files referred to
+        by anyof: and !anyof: conditions.'''
+
+        location = self.kwargs.location
+        if location.startswith("sqlite:"):
+            return os.path.dirname(location[len("sqlite:"):])
+        elif os.path.splitext(location)[1] in ReadRulesFile.EXTENSIONS:
+            return os.path.dirname(location)
+        else:
+            return location
+
     def activateNewRules(self, rules):
 
-        with self.rule_lock:
-            self.__active_rules = {}
-            self.__active_rules.update(rules)
-            self.__active_rules.update(self.kwargs.rules)
-            self.logging.info("Read %s rules from disk and %s defined in config." % (len(rules), len(self.kwargs.rules)))
+        config_rules = self.uplook.dump()["rules"]
+        all_rules = {}
+        all_rules.update(rules)
+        all_rules.update(config_rules)
+        ruleset, engine = self.compileRules(RuleSet, all_rules, self.match, self.kwargs.combine_regex, self.kwargs.analyze_rules, self.kwargs.ignore_missing_fields)
+
+        # The rule set is completely built before it is published by
+        # replacing a single reference.  Events being processed keep using
+        # the rule set they started with.
+        self.__engine = engine
+        self.__active_rules = ruleset
+        if self.match_cache is not None:
+            self.match_cache.clear()
+        if self.workers is not None:
+            self.workers.load(ruleset, all_rules)
+        self.logging.info("Read %s rules from disk and %s defined in config." % (len(rules), len(config_rules)))
+
+    def patchRules(self, changed, removed):
+        '''Activates a new rule set in which only the <changed> rules and
+        the <removed> rule names differ from the active one.'''
+
+        ruleset, engine = self.compileRules(self.__active_rules.patch, changed, removed)
+
+        self.__engine = engine
+        self.__active_rules = ruleset
+        if self.match_cache is not None:
+            self.match_cache.clear()
+        if self.workers is not None:
+            self.workers.patch(ruleset, changed, removed)
+        self.logging.info("Reloaded %s changed and %s removed rules from disk." % (len(changed), len(removed)))
+
+    def compileRules(self, build, *args):
+        '''Returns a tuple of the rule set returned by <build> called with
+        <args> and its engine.
+
+        Both are built in the gevent threadpool so the greenthreads
+        processing events keep running while a large number of rules is
+        compiled.  Only the finished rule set is handed back.'''
+
+        def work():
+            ruleset = build(*args)
+            return ruleset, self.buildEngine(ruleset)
+
+        ruleset, engine = get_hub().threadpool.apply(work)
+        for name, reason in ruleset.rejected.items():
+            self.logging.warning("Rule %s not valid. Skipped. Reason: %s" % (name, reason))
+        self.logFindings(ruleset)
+        self.logEngine(ruleset, engine)
+        return ruleset, engine
+
+    def buildEngine(self, ruleset):
+        '''Returns the engine evaluating <ruleset> according to <engine> or
+        None for the default one.'''
+
+        if self.kwargs.engine == "tree":
+            return DecisionTree(ruleset, self.kwargs.ignore_missing_fields)
+        elif self.kwargs.engine == "codegen":
+            return CodeGen(ruleset, self.kwargs.ignore_missing_fields)
+        return None
+
+    def logEngine(self, ruleset, engine):
+        '''Logs the size of <engine> and writes the generated source to
+        <engine_source> when requested.'''
+
+        if self.kwargs.engine == "tree":
+            self.logging.info("Compiled %s rules into a decision tree of %s nodes." % (len(ruleset.rules), engine.nodes))
+        elif self.kwargs.engine == "codegen":
+            self.logging.info("Compiled %s rules into %s lines of Python." % (len(ruleset.rules), engine.source.count("\n")))
+            if self.kwargs.engine_source != "":
+                try:
+                    with open(self.kwargs.engine_source, 'w') as f:
+                        f.write(engine.source)
+                except Exception as err:
+                    self.logging.warning("Failed to write the generated source to %s.  Reason: %s" % (self.kwargs.engine_source, err))
+
+    def logFindings(self, ruleset):
+        '''Logs the findings of the analysis of <ruleset>.'''
+
+        for name, finding in sorted(ruleset.findings.items()):
+            self.logging.info("Rule %s: %s" % (name, finding))
+        if ruleset.analyze:
+            self.logging.info("Evaluating %s out of %s rules after merging the ones with the same conditions." % (len(ruleset.rules), len(ruleset.names)))
 
     def monitorRuleDirectory(self):
 
@@ -192,12 +526,12 @@ class Match(Actor):
         Loads new rules when changes happen.
         '''
 
-        self.logging.info("Monitoring rules directory '%s' for changes" % (self.kwargs.location))
+        self.logging.info("Monitoring rules location '%s' for changes" % (self.kwargs.location))
 
         while self.loop():
             try:
-                new_rules = self.read_rules_disk.getRulesWait()
-                self.activateNewRules(new_rules)
+                changed, removed = self.read_rules_disk.getChangesWait()
+                self.patchRules(changed, removed)
             except Exception as err:
                 self.logging.warning("Problem reading rules directory.  Reason: %s" % (err))
                 sleep(0.5)
@@ -207,42 +541,336 @@ class Match(Actor):
         the defined header.'''
 
         if isinstance(event.get(), dict):
-            with self.rule_lock:
-                for rule in self.__active_rules:
-                    if self.evaluateCondition(self.__active_rules[rule]["condition"], event):
-                        for queue in self.__active_rules[rule]["queue"]:
-                            e = event.clone()
-                            e.set(rule, '@tmp.%s.rule_file_name' % (self.name))
-                            e.set(self.__active_rules[rule]["condition"], '@tmp.%s.condition' % (self.name))
-                            for name in queue:
-                                if queue[name] is not None:
-                                    for key, value in queue[name].items():
-                                        e.set(value, '@tmp.%s.%s' % (self.name, key))
-                                e.set(name, '@tmp.%s.queue' % (self.name))
-                                self.submit(e, self.pool.getQueue(name))
+            engine = self.__engine
+            if engine is not None:
+                ruleset = engine.ruleset
+            else:
+                ruleset = self.__active_rules
+            evaluation = Evaluation(ruleset, event)
+            if self.match_cache is not None:
+                key = self.match_cache.key(ruleset, evaluation)
+                if key is not None:
+                    result = self.match_cache.get(key)
+                    if result is not None:
+                        self.route(event, *result)
+                        return
+            matched = []
+            unmatched = []
+            if engine is not None:
+                matched = engine.match(evaluation)
+                if self.kwargs.verify_engine:
+                    self.verifyEngine(ruleset, evaluation, matched)
+                if self.kwargs.first_match:
+                    matched = sorted(matched, key=lambda rule: ruleset.rank[rule.name])[:1]
+            else:
+                candidates = ruleset.candidates(evaluation, self.kwargs.ignore_missing_fields)
+                if self.kwargs.first_match:
+                    candidates.sort(key=lambda rule: ruleset.rank[rule.name])
+                for rule in candidates:
+                    if self.evaluateCondition(rule, evaluation):
+                        matched.append(rule)
+                        if self.kwargs.first_match:
+                            break
                     else:
-                        self.submit(event, self.pool.queue.nomatch)
-                        if self.kwargs.log_matches:
-                            self.logging.debug("No match for rule '%s'." % (rule))
+                        unmatched.append(rule)
+            if not self.kwargs.first_match:
+                matched = ruleset.expand(matched)
+            if self.match_cache is not None and key is not None:
+                self.match_cache.store(key, (matched, unmatched))
+            self.route(event, matched, unmatched)
         else:
             raise Exception("Incoming data is not of type dict, dropped.")
 
-    def evaluateCondition(self, conditions, event):
-        for condition in conditions:
-            for field in condition:
-                if event.has('@data.%s' % (field)):
-                    try:
-                        match_result = self.match.do(condition[field], event.get('@data.%s' % (field)))
-                    except Exception as err:
-                        if self.kwargs.log_matches:
-                            self.logging.error("Invalid condition '%s'. Skipped.  Reason: '%s'" % (condition[field], err))
-                        return False
-                    else:
-                        if not match_result:
-                            if self.kwargs.log_matches:
-                                self.logging.debug("field '%s' with condition '%s' DOES NOT MATCH value '%s'" % (field, condition[field], event.get('@data.%s' % (field))))
-                            return False
+    def consumeBatch(self):
+        '''Consumes the inbox in batches of up to <batch_size> events or
+        whatever arrived within <batch_timeout> seconds and evaluates each
+        batch column by column.'''
+
+        while self.loop():
+            batch = self.drainInbox()
+            ruleset = self.__active_rules
+            events = []
+            for event in batch:
+                if isinstance(event.get(), dict):
+                    events.append(event)
+                else:
+                    self.consumeFailed(event, Exception("Incoming data is not of type dict, dropped."))
+
+            evaluation = BatchEvaluation(ruleset, events, self.kwargs.ignore_missing_fields)
+            matched = [[] for event in events]
+            unmatched = [[] for event in events]
+            rules = ruleset.rules
+            if self.kwargs.first_match:
+                rules = sorted(rules, key=lambda rule: ruleset.rank[rule.name])
+            remaining = evaluation.all
+            for rule in rules:
+                result = evaluation.evaluate(rule) & remaining
+                if self.rule_metrics is not None:
+                    self.rule_metrics.recordBulk(rule, bin(remaining).count("1"), bin(result).count("1"))
+                for position in bits(result):
+                    matched[position].append(rule)
+                for position in bits(remaining & ~result):
+                    unmatched[position].append(rule)
+                if self.kwargs.first_match:
+                    remaining &= ~result
+                    if not remaining:
+                        break
+
+            if not self.kwargs.first_match:
+                matched = [ruleset.expand(rules) for rules in matched]
+            self.routeBatch(events, matched, unmatched)
+
+    def consumeWorkers(self):
+        '''Consumes the inbox in batches and sends them to the worker
+        processes.'''
+
+        while self.loop():
+            events = []
+            for event in self.drainInbox():
+                if isinstance(event.get(), dict):
+                    events.append(event)
                 else:
-                    if not self.kwargs.ignore_missing_fields:
-                        return False
-        return True
+                    self.consumeFailed(event, Exception("Incoming data is not of type dict, dropped."))
+            for event, err in self.workers.submit(events):
+                self.consumeFailed(event, err)
+
+    def consumeWorkerResults(self, worker):
+        '''Routes the batches evaluated by <worker>.'''
+
+        while self.loop():
+            try:
+                events, matched, unmatched = self.workers.receive(worker)
+            except EOFError:
+                self.logging.error("Worker process %s died.  Starting a new one." % (worker))
+                for event in self.workers.respawn(worker):
+                    self.consumeFailed(event, Exception("Worker process %s died while evaluating the event." % (worker)))
+            else:
+                self.routeBatch(events, matched, unmatched)
+
+    def routeBatch(self, events, matched, unmatched):
+        '''Routes each of <events> using the rules in the list at the same
+        position in <matched> and <unmatched>.'''
+
+        for position, event in enumerate(events):
+            self.current_event = event
+            try:
+                self.route(event, matched[position], unmatched[position])
+            except Exception as err:
+                self.consumeFailed(event, err)
+            else:
+                self.submit(event, self.pool.queue.success)
+
+    def drainInbox(self):
+        '''Blocks until an event arrives in the inbox and returns it along
+        with the events arriving within <batch_timeout> seconds up to a
+        total of <batch_size>.'''
+
+        batch = [self.pool.queue.inbox.get()]
+        deadline = time() + self.kwargs.batch_timeout
+        while len(batch) < self.kwargs.batch_size:
+            try:
+                batch.append(self.pool.queue.inbox.get(block=False))
+            except QueueEmpty:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                sleep(remaining)
+        return batch
+
+    def postHook(self):
+
+        if self.workers is not None:
+            self.workers.stop()
+
+    def consumeFailed(self, event, err):
+        '''Submits <event> to the failed queue the same way a registered
+        consumer does when it raises <err>.'''
+
+        exc_type, exc_value, exc_traceback = exc_info()
+        if exc_traceback is not None:
+            info = (traceback.extract_tb(exc_traceback)[-1][1], str(exc_type), str(exc_value))
+        else:
+            info = (0, str(type(err)), str(err))
+        event.set(info, "@errors.%s" % (self.name))
+        self.logging.error("%s" % (err))
+        self.submit(event, self.pool.queue.failed)
+
+    def route(self, event, matched, unmatched):
+        '''Submits <event> to the queues of the <matched> rules or once to
+        nomatch when no rule matched.'''
+
+        if self.kwargs.log_matches:
+            for rule in unmatched:
+                self.logging.debug("No match for rule '%s'." % (rule.name))
+
+        if not matched:
+            if self.kwargs.copy_on_write:
+                self.submit(SharedEvent(event), self.pool.queue.nomatch)
+                SharedEvent.release(event)
+            else:
+                self.submit(event, self.pool.queue.nomatch)
+            return
+
+        for rule, name, header in self.destinations(matched):
+            e = self.fanOut(event)
+            tmp = e.data["@tmp"]
+            if self.name in tmp:
+                merged = dict(tmp[self.name])
+                merged.update(header)
+                tmp[self.name] = merged
+            elif self.kwargs.shared_headers:
+                tmp[self.name] = header
+            else:
+                tmp[self.name] = dict(header)
+            self.submit(e, self.pool.getQueue(name))
+
+        # The incoming event continues to the success queue while the
+        # submitted events share its payload.
+        if self.kwargs.copy_on_write:
+            SharedEvent.release(event)
+
+    def destinations(self, matched):
+        '''Returns the list of (rule, queue name, header) tuples the
+        <matched> rules route to.  When <collapse_queues> is enabled, each
+        queue appears only once.'''
+
+        destinations = []
+        if self.kwargs.collapse_queues:
+            seen = set()
+            for rule in sorted(matched, key=lambda r: (-r.priority, r.name)):
+                for name, header in rule.destinations:
+                    if name not in seen:
+                        seen.add(name)
+                        destinations.append((rule, name, header))
+        else:
+            for rule in matched:
+                for name, header in rule.destinations:
+                    destinations.append((rule, name, header))
+        return destinations
+
+    def fanOut(self, event):
+        '''Returns the copy of <event> to submit to a queue.'''
+
+        if self.kwargs.copy_on_write:
+            return SharedEvent(event)
+        else:
+            return event.clone()
+
+    def evaluateCondition(self, rule, evaluation):
+        '''Returns True when all compiled conditions of <rule> match the
+        event of <evaluation>.'''
+
+        if self.rule_metrics is None:
+            return self.rejectedAt(rule, evaluation) is None
+        elif self.rule_metrics.sampled():
+            timings = []
+            rejected_at = self.rejectedAt(rule, evaluation, timings)
+            self.rule_metrics.record(rule, rejected_at, timings)
+            return rejected_at is None
+        else:
+            rejected_at = self.rejectedAt(rule, evaluation)
+            self.rule_metrics.record(rule, rejected_at)
+            return rejected_at is None
+
+    def rejectedAt(self, rule, evaluation, timings=None):
+        '''Returns the position of the condition of <rule> which does not
+        match the event of <evaluation> or None when all conditions match.
+        When <timings> is a list, the time spent on each evaluated condition
+        is appended to it.'''
+
+        for position, condition in enumerate(rule.conditions):
+            if timings is not None:
+                start = time()
+            value = evaluation.resolve(condition.field, condition.path)
+            if value is not MISSING:
+                try:
+                    match_result = evaluation.test(condition, value)
+                except Exception as err:
+                    if self.kwargs.log_matches:
+                        self.logging.error("Invalid condition '%s'. Skipped.  Reason: '%s'" % (condition.condition, err))
+                    match_result = False
+                else:
+                    if not match_result and self.kwargs.log_matches:
+                        self.logging.debug("field '%s' with condition '%s' DOES NOT MATCH value '%s'" % (condition.field, condition.condition, value))
+            else:
+                match_result = self.kwargs.ignore_missing_fields
+            if timings is not None:
+                timings.append(time() - start)
+            if not match_result:
+                return position
+        return None
+
+    def verifyEngine(self, ruleset, evaluation, matched):
+        '''Logs an error when the rules <matched> by the engine differ from
+        the ones matched when evaluating the rules of <ruleset> one by one.'''
+
+        expected = set([rule.name for rule in ruleset.candidates(evaluation, self.kwargs.ignore_missing_fields) if self.rejectedAt(rule, evaluation) is None])
+        if expected != set([rule.name for rule in matched]):
+            self.logging.error("Engine '%s' matched %s instead of %s for event %s." % (self.kwargs.engine, sorted([rule.name for rule in matched]), sorted(expected), evaluation.data))
+
+    def reorderConditions(self):
+        '''Reorders the conditions of each active rule every
+        <adaptive_interval> seconds based upon their measured cost and
+        rejection rate.'''
+
+        while self.loop():
+            sleep(self.kwargs.adaptive_interval)
+            for rule in self.__active_rules.rules:
+                conditions = self.rule_metrics.order(rule)
+                if conditions is not None and conditions != rule.conditions:
+                    rule.conditions = conditions
+                    if self.kwargs.log_matches:
+                        self.logging.debug("Reordered conditions of rule '%s' to %s." % (rule.name, [c.condition for c in conditions]))
+
+    def matchCacheMetricProducer(self):
+        '''Submits the match cache counters to the metrics queue every
+        <frequency> seconds.'''
+
+        hostname = socket.gethostname()
+        while self.loop():
+            for name, value in self.match_cache.dump():
+                metric = Metric(time=time(),
+                                type="wishbone",
+                                source=hostname,
+                                name="module.%s.match_cache.%s" % (self.name, name),
+                                value=value,
+                                unit="",
+                                tags=())
+                self.submit(Event(metric), self.pool.queue.metrics)
+            sleep(self.frequency)
+
+    def engineMetricProducer(self):
+        '''Submits the metrics of the engine to the metrics queue every
+        <frequency> seconds.'''
+
+        hostname = socket.gethostname()
+        while self.loop():
+            if self.__engine is not None:
+                for name, value in self.__engine.dump():
+                    metric = Metric(time=time(),
+                                    type="wishbone",
+                                    source=hostname,
+                                    name="module.%s.engine.%s.%s" % (self.name, self.kwargs.engine, name),
+                                    value=value,
+                                    unit="",
+                                    tags=())
+                    self.submit(Event(metric), self.pool.queue.metrics)
+            sleep(self.frequency)
+
+    def ruleMetricProducer(self):
+        '''Submits the rule metrics to the metrics queue every <frequency>
+        seconds.'''
+
+        hostname = socket.gethostname()
+        while self.loop():
+            names = self.__active_rules.names
+            for name, value in self.rule_metrics.dump(names):
+                metric = Metric(time=time(),
+                                type="wishbone",
+                                source=hostname,
+                                name="module.%s.rule.%s" % (self.name, name),
+                                value=value,
+                                unit="",
+                                tags=())
+                self.submit(Event(metric), self.pool.queue.metrics)
+            sleep(self.frequency)
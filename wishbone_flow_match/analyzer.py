@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  analyzer.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from itertools import combinations
+from .matchrules import EqualString, NotEqualString, More, MoreOrEqual, Less, LessOrEqual, Equal, NotEqual, Regex, NegRegex
+
+# The largest number of conditions of which all subsets are enumerated.
+SUBSETS = 10
+
+
+def signature(rule):
+    '''Returns a hashable representation of the conditions of <rule> which
+    is the same for all rules having the same conditions in any order.'''
+
+    return tuple(sorted(set([(condition.field, condition.condition) for condition in rule.conditions])))
+
+
+def unsatisfiable(rule):
+    '''Returns the reason why no event carrying all the fields of <rule>
+    can ever match it or None when it can not be proven.
+
+    Only contradicting conditions on the same field are detected: multiple
+    ==: values, a ==: and !==: of the same value, the same pattern in a re:
+    and !re:, and numeral conditions not leaving any value.'''
+
+    fields = {}
+    for condition in rule.conditions:
+        fields.setdefault(condition.field, []).append(condition)
+
+    for field, conditions in fields.items():
+        strings = set([c.operator.value for c in conditions if type(c.operator) is EqualString])
+        if len(strings) > 1:
+            return "field '%s' can not be equal to %s at the same time" % (field, " and ".join(sorted(strings)))
+        for c in conditions:
+            if type(c.operator) is NotEqualString and c.operator.value in strings:
+                return "field '%s' can not be equal and not equal to '%s'" % (field, c.operator.value)
+
+        patterns = set([c.operator.value.pattern for c in conditions if type(c.operator) is Regex])
+        for c in conditions:
+            if type(c.operator) is NegRegex and c.operator.value.pattern in patterns:
+                return "field '%s' can not match and not match '%s'" % (field, c.operator.value.pattern)
+
+        reason = _numeralReason([c for c in conditions if type(c.operator) in (More, MoreOrEqual, Less, LessOrEqual, Equal, NotEqual)])
+        if reason is not None:
+            return "field '%s' %s" % (field, reason)
+    return None
+
+
+def _numeralReason(conditions):
+
+    lower = None
+    upper = None
+    equal = set()
+    not_equal = set()
+    for c in conditions:
+        value = c.operator.value
+        if value != value and type(c.operator) is not NotEqual:
+            return "can not be compared to NaN using %s" % (c.condition)
+        if type(c.operator) in (More, MoreOrEqual):
+            bound = (value, type(c.operator) is MoreOrEqual)
+            if lower is None or bound[0] > lower[0] or (bound[0] == lower[0] and not bound[1]):
+                lower = bound
+        elif type(c.operator) in (Less, LessOrEqual):
+            bound = (value, type(c.operator) is LessOrEqual)
+            if upper is None or bound[0] < upper[0] or (bound[0] == upper[0] and not bound[1]):
+                upper = bound
+        elif type(c.operator) is Equal:
+            equal.add(value)
+        else:
+            not_equal.add(value)
+
+    if len(equal) > 1:
+        return "can not be equal to %s at the same time" % (" and ".join([str(v) for v in sorted(equal)]))
+    if lower is not None and upper is not None:
+        if lower[0] > upper[0] or (lower[0] == upper[0] and not (lower[1] and upper[1])):
+            return "can not be in an empty range"
+        if lower[0] == upper[0] and lower[0] in not_equal:
+            return "can not be in an empty range"
+    for value in equal:
+        if value in not_equal:
+            return "can not be equal and not equal to %s" % (value)
+        if lower is not None and (value < lower[0] or (value == lower[0] and not lower[1])):
+            return "can not be equal to %s and outside the range" % (value)
+        if upper is not None and (value > upper[0] or (value == upper[0] and not upper[1])):
+            return "can not be equal to %s and outside the range" % (value)
+    return None
+
+
+def subsumed(groups, containing, signatures, names):
+    '''Yields (name, other) tuples of the rules of which the conditions
+    are a superset of the conditions of the rule named <other>, so every
+    event matching the former matches the latter as well.  Only the leaders
+    of <groups>, which maps each signature to its rules, are considered and
+    only the pairs involving a rule in <names>.  <signatures> maps the name
+    of each rule to its signature and <containing> maps each condition to
+    the signatures having it.
+
+    The signatures contained in the one of a rule are looked up in <groups>
+    by enumerating its subsets.  The signatures containing it are the
+    intersection of the ones containing each of its conditions.'''
+
+    found = set()
+    for name in names:
+        sig = signatures.get(name)
+        members = groups.get(sig)
+        if not members or members[0].name != name:
+            continue
+
+        if len(sig) <= SUBSETS:
+            for size in range(len(sig)):
+                for subset in combinations(sig, size):
+                    if subset in groups:
+                        found.add((name, groups[subset][0].name))
+        else:
+            if () in groups:
+                found.add((name, groups[()][0].name))
+            counts = {}
+            for condition in sig:
+                for other in containing[condition]:
+                    counts[other] = counts.get(other, 0) + 1
+            for other, count in counts.items():
+                if count == len(other) and other != sig:
+                    found.add((name, groups[other][0].name))
+
+        if sig:
+            sets = sorted([containing[condition] for condition in sig], key=len)
+            supersets = set(sets[0]).intersection(*sets[1:])
+        else:
+            supersets = groups.keys()
+        for other in supersets:
+            if other != sig:
+                found.add((groups[other][0].name, name))
+
+    for pair in sorted(found):
+        yield pair
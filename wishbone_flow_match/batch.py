@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  batch.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .matchrules import Numeral
+from .ruleset import Evaluation, MISSING
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def bitmap(results):
+    '''Converts a sequence of booleans into an integer having bit <n> set
+    when element <n> is True.'''
+
+    if numpy is not None and isinstance(results, numpy.ndarray):
+        return int.from_bytes(numpy.packbits(results, bitorder="little").tobytes(), "little")
+    else:
+        return int("".join(["1" if r else "0" for r in reversed(results)]) or "0", 2)
+
+
+def bits(value):
+    '''Yields the position of each bit set in <value>.'''
+
+    while value:
+        lowest = value & -value
+        yield lowest.bit_length() - 1
+        value ^= lowest
+
+
+class BatchEvaluation():
+
+    '''
+    Evaluates a batch of events against a RuleSet column by column.
+
+    The values of each referenced field are extracted into a column once.
+    Each distinct condition is evaluated over the complete column and its
+    result is stored as a bitmap having bit <n> set when event <n> passes
+    the condition.  The result of a rule is the AND of its condition
+    bitmaps.
+
+    Conditions with a comparison function (==:, !==:, >:, >=:, <:, <=:, =:,
+    !=:) are evaluated on the converted column at once, using NumPy when it
+    is installed.  The other conditions are evaluated per value.
+
+    Parameters:
+
+        ruleset(RuleSet):   The rule set to evaluate.
+        events(list):       The events to evaluate.
+        ignore_missing_fields(bool):    A missing field passes the condition.
+    '''
+
+    def __init__(self, ruleset, events, ignore_missing_fields=False):
+
+        self.ruleset = ruleset
+        self.evaluations = [Evaluation(ruleset, event) for event in events]
+        self.ignore_missing_fields = ignore_missing_fields
+        self.all = (1 << len(events)) - 1
+        self.columns = {}
+        self.results = {}
+
+    def evaluate(self, rule):
+        '''Returns the bitmap of the events matching <rule>.'''
+
+        result = self.all
+        for condition in rule.conditions:
+            result &= self.condition(condition)
+            if not result:
+                break
+        return result
+
+    def condition(self, condition):
+        '''Returns the bitmap of the events passing <condition>.'''
+
+        key = (condition.field, condition.condition)
+        try:
+            return self.results[key]
+        except KeyError:
+            column, present = self.column(condition)
+            if condition.operator.compare is None:
+                result = bitmap([self.__test(condition, evaluation, value) for evaluation, value in zip(self.evaluations, column)])
+                result &= present
+            elif isinstance(condition.operator, Numeral):
+                converted, valid = self.converted(condition, float)
+                result = bitmap(condition.operator.compare(converted, condition.operator.value)) & valid
+            else:
+                converted, valid = self.converted(condition, str)
+                result = bitmap(condition.operator.compare(converted, condition.operator.value)) & valid
+            if self.ignore_missing_fields:
+                result |= self.all & ~present
+            self.results[key] = result
+            return result
+
+    def column(self, condition):
+        '''Returns the values of the field of <condition> and the bitmap of
+        the events having the field.'''
+
+        try:
+            return self.columns[condition.field]
+        except KeyError:
+            column = [evaluation.resolve(condition.field, condition.path) for evaluation in self.evaluations]
+            present = bitmap([value is not MISSING for value in column])
+            self.columns[condition.field] = (column, present)
+            return column, present
+
+    def converted(self, condition, convert):
+        '''Returns the values of the field of <condition> converted by
+        <convert> and the bitmap of the events for which this succeeded.'''
+
+        key = (condition.field, convert)
+        try:
+            return self.columns[key]
+        except KeyError:
+            column, present = self.column(condition)
+            values = []
+            valid = []
+            default = 0.0 if convert is float else ""
+            for value in column:
+                try:
+                    if value is MISSING:
+                        raise ValueError()
+                    values.append(convert(value))
+                    valid.append(True)
+                except Exception:
+                    values.append(default)
+                    valid.append(False)
+            if numpy is not None:
+                values = numpy.array(values, dtype=float if convert is float else object)
+            else:
+                values = _Column(values)
+            self.columns[key] = (values, bitmap(valid))
+            return self.columns[key]
+
+    def __test(self, condition, evaluation, value):
+
+        if value is MISSING:
+            return False
+        try:
+            return evaluation.test(condition, value)
+        except Exception:
+            return False
+
+
+class _Column(list):
+
+    '''
+    A list of values on which a comparison function is applied element wise
+    against a constant, mimicking NumPy arrays.
+    '''
+
+    def __lt__(self, other):
+        return [v < other for v in self]
+
+    def __le__(self, other):
+        return [v <= other for v in self]
+
+    def __gt__(self, other):
+        return [v > other for v in self]
+
+    def __ge__(self, other):
+        return [v >= other for v in self]
+
+    def __eq__(self, other):
+        return [v == other for v in self]
+
+    def __ne__(self, other):
+        return [v != other for v in self]
+
+    __hash__ = None
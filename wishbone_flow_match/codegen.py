@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  codegen.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .matchrules import Regex, NegRegex, EqualString, NotEqualString, More, MoreOrEqual, Less, LessOrEqual, Equal, NotEqual, HasMember, HasNotMember, AnyOf, NotAnyOf
+from .ruleset import MISSING
+
+COMPARISONS = {More: ">", MoreOrEqual: ">=", Less: "<", LessOrEqual: "<=", Equal: "==", NotEqual: "!="}
+
+
+def call(operator, value):
+    '''Applies an operator which is not inlined to <value>.'''
+
+    try:
+        return bool(operator(value))
+    except Exception:
+        return False
+
+
+class CodeGen():
+
+    '''
+    Compiles the rules of a RuleSet into the source of a Python function
+    which is compiled once.
+
+    The generated function looks up each referenced field once and converts
+    its value to a string and a float once when a condition needs that.
+    These values are passed on to the generated functions evaluating the
+    rules using a tuple.  The conditions are inlined into one expression per
+    rule.  All generated functions are defined at the module level of the
+    generated source and their constants are global variables, which keeps
+    the time to compile the source proportional to the number of rules.
+
+    The rules stored in the FieldIndex of a field under a ==: value are
+    grouped per value into a function which is looked up in a dict using
+    the value of the field, which makes the cost of these rules independent
+    of their number.  All other rules are evaluated in one function.
+
+    The generated source is available in <source>.
+
+    Parameters:
+
+        ruleset(RuleSet):   The rule set to compile.
+        ignore_missing_fields(bool):    A missing field passes the condition.
+    '''
+
+    def __init__(self, ruleset, ignore_missing_fields=False):
+
+        self.ruleset = ruleset
+        self.ignore_missing_fields = ignore_missing_fields
+        self.events = 0
+        self.constants = []
+        self.fields = {}
+        self.needs = {}
+
+        for rule in ruleset.rules:
+            for condition in rule.conditions:
+                self.fields.setdefault(condition.field, (len(self.fields), condition.path))
+                self.needs.setdefault(condition.field, set())
+
+        self.source = self.__generate()
+        namespace = {"R": ruleset.rules, "MISSING": MISSING, "call": call}
+        namespace.update([("_k%s" % (i), constant) for i, constant in enumerate(self.constants)])
+        exec(compile(self.source, "<match rules>", "exec"), namespace)
+        self.function = namespace["match"]
+
+    def __constant(self, value):
+
+        self.constants.append(value)
+        return "_k%s" % (len(self.constants) - 1)
+
+    def __expression(self, condition):
+        '''Returns the Python expression evaluating <condition>.'''
+
+        position = self.fields[condition.field][0] * 3
+        raw = "v[%s]" % (position)
+        string = "v[%s]" % (position + 1)
+        number = "v[%s]" % (position + 2)
+        operator = condition.operator
+        kind = type(operator)
+        if kind in COMPARISONS:
+            self.needs[condition.field].add("number")
+        else:
+            self.needs[condition.field].add("string")
+
+        if kind is Regex:
+            expression = "(%s is not None and %s(%s) is not None)" % (string, self.__constant(operator.value.search), string)
+        elif kind is NegRegex:
+            expression = "(%s is not None and %s(%s) is None)" % (string, self.__constant(operator.value.search), string)
+        elif kind is EqualString:
+            expression = "%s == %s" % (string, self.__constant(operator.value))
+        elif kind is NotEqualString:
+            expression = "(%s is not None and %s != %s)" % (string, string, self.__constant(operator.value))
+        elif kind in COMPARISONS:
+            expression = "(%s is not None and %s %s %s)" % (number, number, COMPARISONS[kind], self.__constant(operator.value))
+        elif kind is HasMember:
+            expression = "(isinstance(%s, list) and %s in %s)" % (raw, self.__constant(operator.value), raw)
+        elif kind is HasNotMember:
+            expression = "(isinstance(%s, list) and %s not in %s)" % (raw, self.__constant(operator.value), raw)
+        elif kind is AnyOf:
+            expression = "(call(%s, %s) if isinstance(%s, list) else (%s is not None and %s in %s))" % (self.__constant(operator), raw, raw, string, string, self.__constant(operator.value))
+        elif kind is NotAnyOf:
+            expression = "(call(%s, %s) if isinstance(%s, list) else (%s is not None and %s not in %s))" % (self.__constant(operator), raw, raw, string, string, self.__constant(operator.value))
+        else:
+            expression = "call(%s, %s)" % (self.__constant(operator), raw)
+
+        if self.ignore_missing_fields:
+            return "(%s is MISSING or %s)" % (raw, expression)
+        else:
+            return "(%s is not MISSING and %s)" % (raw, expression)
+
+    def __block(self, name, rules):
+        '''Returns the source of a function appending the matching rules of
+        <rules> to a list.  <rules> is a list of (position, rule, skip)
+        tuples in which <skip> is a condition of the rule known to pass or
+        None.'''
+
+        lines = ["def %s(v, matched):" % (name)]
+        for position, rule, skip in rules:
+            conditions = [self.__expression(c) for c in rule.conditions if c is not skip]
+            if conditions:
+                lines.append("    if %s:" % (" and ".join(conditions)))
+                lines.append("        matched.append(R[%s])" % (position))
+            else:
+                lines.append("    matched.append(R[%s])" % (position))
+        lines.append("    return")
+        return lines
+
+    def __generate(self):
+
+        groups = {}
+        unindexed = []
+        for position, rule in enumerate(self.ruleset.rules):
+            placement = self.ruleset.placement.get(rule.name)
+            if placement is not None and placement[0] == "index" and type(placement[1].operator) is EqualString:
+                groups.setdefault(placement[1].field, {}).setdefault(placement[1].operator.value, []).append((position, rule, placement[1]))
+            else:
+                unindexed.append((position, rule, None))
+
+        lines = self.__block("evaluate", unindexed)
+
+        dispatch = []
+        for field, values in sorted(groups.items()):
+            position = self.fields[field][0]
+            self.needs[field].add("string")
+            entries = []
+            for value, rules in sorted(values.items()):
+                name = "_f%s_%s" % (position, len(entries))
+                lines.extend(self.__block(name, rules))
+                entries.append("%s: %s" % (repr(value), name))
+            lines.append("_d%s = {%s}" % (position, ", ".join(entries)))
+            lines.append("_a%s = tuple(_d%s.values())" % (position, position))
+            dispatch.append(position)
+
+        lines.append("def match(data):")
+        values = []
+        for field, (position, path) in sorted(self.fields.items(), key=lambda f: f[1][0]):
+            lines.append("    f = data")
+            for key in path:
+                lines.append("    f = f.get(%s, MISSING) if isinstance(f, dict) else MISSING" % (repr(key)))
+            lines.append("    s%s = n%s = None" % (position, position))
+            if self.needs[field]:
+                lines.append("    if f is not MISSING:")
+            if "string" in self.needs[field]:
+                lines.append("        try:")
+                lines.append("            s%s = str(f)" % (position))
+                lines.append("        except Exception:")
+                lines.append("            pass")
+            if "number" in self.needs[field]:
+                lines.append("        try:")
+                lines.append("            n%s = float(f)" % (position))
+                lines.append("        except Exception:")
+                lines.append("            pass")
+            lines.append("    f%s = f" % (position))
+            values.extend(["f%s" % (position), "s%s" % (position), "n%s" % (position)])
+        lines.append("    v = (%s)" % ("".join(["%s, " % (value) for value in values])))
+        lines.append("    matched = []")
+        lines.append("    evaluate(v, matched)")
+        for position in dispatch:
+            lines.append("    if f%s is not MISSING:" % (position))
+            lines.append("        b = _d%s.get(s%s)" % (position, position))
+            lines.append("        if b is not None:")
+            lines.append("            b(v, matched)")
+            if self.ignore_missing_fields:
+                lines.append("    else:")
+                lines.append("        for b in _a%s:" % (position))
+                lines.append("            b(v, matched)")
+        lines.append("    return matched")
+        return "\n".join(lines) + "\n"
+
+    def match(self, evaluation):
+        '''Returns the list of rules matching the event of <evaluation>.'''
+
+        self.events += 1
+        return self.function(evaluation.data)
+
+    def dump(self):
+        '''Yields (name, value) tuples of the size of the generated code.'''
+
+        yield "lines", self.source.count("\n")
+        yield "constants", len(self.constants)
+        yield "events", self.events
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  matchcache.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from collections import OrderedDict
+from .ruleset import MISSING
+
+
+class MatchCache():
+
+    '''
+    A bounded LRU cache of the evaluation results of a rule set.
+
+    The outcome of evaluating a rule set only depends upon the values of the
+    fields its conditions refer to, so the tuple of those values is used as
+    key.  Each value is paired with its type so values which compare equal
+    but are matched differently, such as 1, 1.0, True and "1", do not share
+    an entry.  Events of which one of these values can not be hashed, such
+    as a list or a dict, are not cached.
+
+    The cache belongs to a single rule set.  It is cleared as soon as it is
+    used with another one.
+
+    Counters:
+
+        hits:       The number of lookups which found a result.
+        misses:     The number of lookups which did not find a result.
+        evictions:  The number of results dropped to make room.
+        skipped:    The number of events which could not be cached.
+
+    Parameters:
+
+        size(int):  The max number of results to keep.
+    '''
+
+    def __init__(self, size):
+
+        self.size = size
+        self.ruleset = None
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    def key(self, ruleset, evaluation):
+        '''Returns the key of the event of <evaluation> or None when it can
+        not be cached.  Clears the cache when <ruleset> is not the rule set
+        of the cached results.'''
+
+        if ruleset is not self.ruleset:
+            self.clear()
+            self.ruleset = ruleset
+
+        values = []
+        for field, path in ruleset.fields:
+            value = evaluation.resolve(field, path)
+            if value is MISSING:
+                values.append(MISSING)
+            else:
+                values.append((type(value), value))
+        key = tuple(values)
+        try:
+            hash(key)
+        except TypeError:
+            self.skipped += 1
+            return None
+        return key
+
+    def get(self, key):
+        '''Returns the result stored under <key> or None.'''
+
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def store(self, key, result):
+        '''Stores <result> under <key> and evicts the least recently used
+        result when the cache is full.'''
+
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        '''Drops all results.'''
+
+        self.results.clear()
+
+    def dump(self):
+        '''Yields (name, value) tuples of the counters.'''
+
+        for name in ["hits", "misses", "evictions", "skipped"]:
+            yield name, getattr(self, name)
+        yield "size", len(self.results)
@@ -22,7 +22,242 @@
 #
 #
 
+import os
 import re
+import operator
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+
+class Operator():
+
+    '''
+    A condition operator compiled against a constant value.
+
+    The constant is converted once when the operator is created so calling
+    the operator against event data only performs the comparison itself.
+    '''
+
+    # The comparison function applied to a converted value and the
+    # constant.  Operators having one can be evaluated on a whole column of
+    # values at once.
+    compare = None
+
+    def __init__(self, value):
+        self.value = self.convert(value)
+
+    def convert(self, value):
+        return value
+
+    def __call__(self, data):
+        raise NotImplementedError()
+
+
+class Regex(Operator):
+
+    def convert(self, value):
+        return re.compile(value)
+
+    def __call__(self, data):
+        return bool(self.value.search(str(data)))
+
+
+class NegRegex(Regex):
+
+    def __call__(self, data):
+        return not bool(self.value.search(str(data)))
+
+
+class RegexSet():
+
+    '''
+    Searches a value for multiple regex patterns at once.
+
+    Running a regex is expensive compared to looking for a plain substring
+    so each pattern is reduced to the longest literal which any match of
+    it has to contain.  Only the patterns of which the literal occurs in
+    the value are confirmed by running their regex.  Patterns without such a
+    literal, like the ones containing top level alternations or the
+    ignorecase flag, are always run.
+
+    Parameters:
+
+        patterns(list): A list of regex pattern strings.
+    '''
+
+    def __init__(self, patterns):
+
+        self.patterns = []
+        self.literals = {}
+        for pattern in patterns:
+            try:
+                regex = re.compile(pattern)
+            except Exception:
+                continue
+            literal = self.literal(pattern)
+            self.literals[pattern] = literal
+            self.patterns.append((literal, regex.search, pattern))
+        # The patterns with the longest literal are the least likely to be
+        # run.
+        self.patterns.sort(key=lambda p: -len(p[0] or ""))
+
+    def __contains__(self, pattern):
+
+        return pattern in self.literals
+
+    def literal(self, pattern):
+        '''Returns the longest literal string every match of <pattern>
+        contains or None.
+
+        The literal is taken from the consecutive literal characters at the
+        top level of the parsed pattern.  Groups, alternations, classes and
+        repeats end a literal without contributing to it.'''
+
+        try:
+            parsed = sre_parse.parse(pattern)
+        except Exception:
+            return None
+        flags = parsed.state.flags if hasattr(parsed, "state") else parsed.pattern.flags
+        if flags & re.IGNORECASE:
+            return None
+
+        runs = [[]]
+        for op, value in parsed:
+            if op is sre_constants.LITERAL:
+                runs[-1].append(chr(value))
+            elif runs[-1]:
+                runs.append([])
+
+        literal = max(["".join(run) for run in runs], key=len)
+        return literal or None
+
+    def search(self, data):
+        '''Returns the set of patterns found in <data>.'''
+
+        data = str(data)
+        return set([pattern for literal, search, pattern in self.patterns if (literal is None or literal in data) and search(data)])
+
+
+class EqualString(Operator):
+
+    compare = staticmethod(operator.eq)
+
+    def convert(self, value):
+        return str(value)
+
+    def __call__(self, data):
+        return self.value == str(data)
+
+
+class NotEqualString(EqualString):
+
+    compare = staticmethod(operator.ne)
+
+    def __call__(self, data):
+        return not(self.value == str(data))
+
+
+class Numeral(Operator):
+
+    def convert(self, value):
+        return float(value)
+
+
+class More(Numeral):
+
+    compare = staticmethod(operator.gt)
+
+    def __call__(self, data):
+        return float(data) > self.value
+
+
+class MoreOrEqual(Numeral):
+
+    compare = staticmethod(operator.ge)
+
+    def __call__(self, data):
+        return float(data) >= self.value
+
+
+class Less(Numeral):
+
+    compare = staticmethod(operator.lt)
+
+    def __call__(self, data):
+        return float(data) < self.value
+
+
+class LessOrEqual(Numeral):
+
+    compare = staticmethod(operator.le)
+
+    def __call__(self, data):
+        return float(data) <= self.value
+
+
+class Equal(Numeral):
+
+    compare = staticmethod(operator.eq)
+
+    def __call__(self, data):
+        return float(data) == self.value
+
+
+class NotEqual(Numeral):
+
+    compare = staticmethod(operator.ne)
+
+    def __call__(self, data):
+        return float(data) != self.value
+
+
+class HasMember(EqualString):
+
+    compare = None
+
+    def __call__(self, data):
+        if isinstance(data, list):
+            return self.value in data
+        else:
+            return False
+
+
+class HasNotMember(EqualString):
+
+    compare = None
+
+    def __call__(self, data):
+        if isinstance(data, list):
+            return self.value not in data
+        else:
+            return False
+
+
+class AnyOf(Operator):
+
+    '''
+    Matches when the value, or any element of a list value, is one of a set
+    of strings.  The set is given as a list of values.
+    '''
+
+    def convert(self, value):
+        return frozenset([str(v) for v in value])
+
+    def __call__(self, data):
+        if isinstance(data, list):
+            return not self.value.isdisjoint([str(d) for d in data])
+        else:
+            return str(data) in self.value
+
+
+class NotAnyOf(AnyOf):
+
+    def __call__(self, data):
+        return not AnyOf.__call__(self, data)
 
 
 class MatchRules():
@@ -42,9 +277,23 @@ class MatchRules():
     !=:     Not equal to (numeral only)
     in:     Check whether element is in list
     !in:    Check whether element is not in list
+    anyof:  Check whether the value or an element of the list is one of
+            the comma separated values or the values listed in @<filename>
+    !anyof: The negation of anyof:
+
+    Value files of anyof: and !anyof: contain one value per line.  Empty
+    lines and lines starting with # are skipped.  Relative filenames are
+    relative to <directory>.  The content of a file is read once for as long
+    as its modification time and size do not change.
+
+    Parameters:
+
+        directory(str): The directory containing the value files.
     '''
 
-    def __init__(self):
+    def __init__(self, directory=""):
+        self.directory = directory
+        self.value_files = {}
         self.methods = {"re": self.regex,
                         "!re": self.negRegex,
                         "==": self.equalString,
@@ -56,12 +305,33 @@ class MatchRules():
                         "=": self.equal,
                         "!=": self.notEqual,
                         "in": self.hasMember,
-                        "!in": self.hasNotMember
+                        "!in": self.hasNotMember,
+                        "anyof": self.anyOf,
+                        "!anyof": self.notAnyOf
                         }
+        self.operators = {"re": Regex,
+                          "!re": NegRegex,
+                          "==": EqualString,
+                          "!==": NotEqualString,
+                          ">": More,
+                          ">=": MoreOrEqual,
+                          "<": Less,
+                          "<=": LessOrEqual,
+                          "=": Equal,
+                          "!=": NotEqual,
+                          "in": HasMember,
+                          "!in": HasNotMember,
+                          "anyof": AnyOf,
+                          "!anyof": NotAnyOf
+                          }
 
     def __validateCondition(self, condition):
 
-        s = condition.split(':')
+        try:
+            s = condition.split(':')
+        except AttributeError:
+            raise Exception("Condition '%s' is not a string." % (condition))
+
         if len(s) == 1:
             raise Exception("Condition '%s' is not valid." % (condition))
 
@@ -70,6 +340,43 @@ class MatchRules():
         else:
             return s[0], ":".join(s[1:])
 
+    def compile(self, condition):
+        '''Parses <condition> and returns the matching operator object
+        with its constant already converted.'''
+
+        method, value = self.__validateCondition(condition)
+        try:
+            if issubclass(self.operators[method], AnyOf):
+                value = self.values(value)
+            return self.operators[method](value)
+        except Exception as err:
+            raise Exception("Condition '%s' has an invalid value '%s'. Reason: %s" % (condition, value, err))
+
+    def values(self, value):
+        '''Returns the list of values of an anyof: condition.  <value> is
+        either a comma separated list or @<filename>.'''
+
+        if not value.startswith("@"):
+            return value.split(",")
+
+        filename = self.valueFile(value)
+        stat = os.stat(filename)
+        try:
+            known = self.value_files[filename]
+            if known[0] == (stat.st_mtime, stat.st_size):
+                return known[1]
+        except KeyError:
+            pass
+        with open(filename, 'r') as f:
+            values = frozenset([line.strip() for line in f if line.strip() and not line.strip().startswith("#")])
+        self.value_files[filename] = ((stat.st_mtime, stat.st_size), values)
+        return values
+
+    def valueFile(self, value):
+        '''Returns the path of the file referred to by the @<filename>
+        <value> of an anyof: condition.'''
+
+        return os.path.join(self.directory, value[1:])
 
     def do(self, condition, data):
 
@@ -120,3 +427,9 @@ class MatchRules():
             return str(value) not in data
         else:
             return False
+
+    def anyOf(self, value, data):
+        return AnyOf(self.values(value))(data)
+
+    def notAnyOf(self, value, data):
+        return NotAnyOf(self.values(value))(data)
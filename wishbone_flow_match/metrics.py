@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os
+import re
+
+UNSAFE = re.compile(r'[^\w-]')
+
+
+def metricName(name):
+    '''Returns the rule name <name> as a single metric name segment.  Rules
+    read from a file are named after the file without the directory and
+    extension.  Characters other than letters, digits, "_" and "-" are
+    replaced by "_".'''
+
+    if "/" in name:
+        name = os.path.splitext(os.path.basename(name))[0]
+    return UNSAFE.sub("_", name)
+
+
+class RuleMetrics():
+
+    '''
+    Aggregates the evaluation metrics of rules and their conditions.
+
+    Counters are kept for every evaluation.  Timings are only measured for
+    one in <sample> evaluations since measuring time has a cost of its own.
+    The per condition metrics start over when the conditions of a rule
+    change, such as when they are reordered, while the per rule metrics
+    keep counting.
+
+    Per rule:
+
+        evaluations:    The number of times the rule was evaluated.
+        matches:        The number of times the rule matched.
+        sampled:        The number of evaluations of which the time was measured.
+        time:           The total time in seconds of the sampled evaluations.
+        regex_time:     The part of <time> spent on re: and !re: conditions.
+
+    Per condition, identified by its position in the rule:
+
+        evaluations:    The number of times the condition was evaluated.
+        rejections:     The number of times evaluation of the rule stopped at
+                        this condition.
+        time:           The total time in seconds of the sampled evaluations.
+
+    Parameters:
+
+        sample(int):    Measure the time of one in <sample> evaluations.
+    '''
+
+    def __init__(self, sample=100):
+
+        self.sample = max(1, sample)
+        self.counter = 0
+        self.rules = {}
+
+    def sampled(self):
+        '''Returns True when the next evaluation should be timed.'''
+
+        self.counter += 1
+        if self.counter >= self.sample:
+            self.counter = 0
+            return True
+        return False
+
+    def record(self, rule, rejected_at, timings=None):
+        '''Records an evaluation of <rule> which stopped at condition
+        position <rejected_at> or matched when None.  <timings> is the list
+        of time spent on each evaluated condition, if measured.'''
+
+        metrics = self.__get(rule)
+        metrics["evaluations"] += 1
+        if rejected_at is None:
+            metrics["matches"] += 1
+            evaluated = len(rule.conditions)
+        else:
+            metrics["rejections"][rejected_at] += 1
+            evaluated = rejected_at + 1
+        for position in range(evaluated):
+            metrics["condition_evaluations"][position] += 1
+
+        if timings is not None:
+            metrics["sampled"] += 1
+            for position, elapsed in enumerate(timings):
+                metrics["time"] += elapsed
+                metrics["condition_sampled"][position] += 1
+                metrics["condition_time"][position] += elapsed
+                if rule.conditions[position].regex:
+                    metrics["regex_time"] += elapsed
+
+    def recordBulk(self, rule, evaluations, matches):
+        '''Records <evaluations> evaluations of <rule> of which <matches>
+        matched without per condition detail.'''
+
+        metrics = self.__get(rule)
+        metrics["evaluations"] += evaluations
+        metrics["matches"] += matches
+
+    def order(self, rule, minimum=100):
+        '''Returns the conditions of <rule> in the order with the lowest
+        expected evaluation cost or None when there are not enough
+        measurements yet.
+
+        Since a rule only matches when all its conditions match, the order of
+        the conditions does not change the result.  The expected cost is the
+        lowest when the conditions are sorted by their mean cost divided by
+        their rejection rate.  Each condition needs to be evaluated at least
+        <minimum> times and timed at least once.'''
+
+        try:
+            metrics = self.rules[rule.name]
+        except KeyError:
+            return None
+        if metrics["conditions"] is not rule.conditions or len(rule.conditions) < 2:
+            return None
+
+        ranks = []
+        for position, condition in enumerate(rule.conditions):
+            evaluations = metrics["condition_evaluations"][position]
+            sampled = metrics["condition_sampled"][position]
+            if evaluations < minimum or sampled == 0:
+                return None
+            cost = metrics["condition_time"][position] / sampled
+            rejection_rate = float(metrics["rejections"][position]) / evaluations
+            if rejection_rate == 0:
+                rank = float("inf")
+            else:
+                rank = cost / rejection_rate
+            ranks.append((rank, position, condition))
+
+        ranks.sort(key=lambda r: (r[0], r[1]))
+        return tuple([condition for rank, position, condition in ranks])
+
+    def dump(self, names=None):
+        '''Yields (name, value) tuples of all metrics.  The names start with
+        the rule name converted by metricName().  When <names> is provided,
+        the metrics of rules not in <names> are dropped.'''
+
+        if names is not None:
+            for name in list(self.rules.keys()):
+                if name not in names:
+                    del(self.rules[name])
+
+        for name, metrics in self.rules.items():
+            name = metricName(name)
+            for key in ["evaluations", "matches", "sampled", "time", "regex_time"]:
+                yield "%s.%s" % (name, key), metrics[key]
+            for position in range(len(metrics["rejections"])):
+                yield "%s.condition.%s.evaluations" % (name, position), metrics["condition_evaluations"][position]
+                yield "%s.condition.%s.rejections" % (name, position), metrics["rejections"][position]
+                yield "%s.condition.%s.time" % (name, position), metrics["condition_time"][position]
+
+    def __get(self, rule):
+
+        try:
+            metrics = self.rules[rule.name]
+        except KeyError:
+            metrics = {"conditions": None,
+                       "evaluations": 0,
+                       "matches": 0,
+                       "sampled": 0,
+                       "time": 0.0,
+                       "regex_time": 0.0}
+            self.rules[rule.name] = metrics
+
+        # The rule level counters keep counting when the conditions of a
+        # rule are reordered or replaced.  The condition counters are
+        # position based so they start over.
+        if metrics["conditions"] is not rule.conditions:
+            size = len(rule.conditions)
+            metrics["conditions"] = rule.conditions
+            metrics["condition_evaluations"] = [0] * size
+            metrics["rejections"] = [0] * size
+            metrics["condition_sampled"] = [0] * size
+            metrics["condition_time"] = [0.0] * size
+        return metrics
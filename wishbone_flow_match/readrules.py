@@ -23,43 +23,113 @@
 #
 
 from gevent import spawn
-from gevent import sleep
 from gevent import event
+from gevent import get_hub
 from glob import glob
 import os
+import hashlib
+import json
 import yaml
 from yaml.parser import ParserError
-from deepdiff import DeepDiff
+from .watchdir import createWatcher
 
+# libyaml's loader is a lot faster than the pure Python one.
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-class ReadRulesDisk():
+
+class ReadRules():
+
+    '''
+    The base of the rule readers.
+
+    Parameters:
+
+        logger(Logging):    The logger receiving the warnings of the reader.
+    '''
+
+    def __init__(self, logger):
+        self.logging = logger
+
+    def inThread(self, function, *args):
+        '''Executes <function> in the gevent threadpool, blocking only the
+        current greenthread, and logs the warnings it collected.'''
+
+        warnings = []
+        result = get_hub().threadpool.apply(function, args + (warnings,))
+        for warning in warnings:
+            self.logging.warning(warning)
+        return result
+
+    def ruleCompliant(self, rule):
+
+        '''Does basic rule validation'''
+
+        assert isinstance(rule["condition"], list), "Condition needs to be of type list."
+        for c in rule["condition"]:
+            assert isinstance(c, dict), "An individual condition needs to be of type dict."
+        assert isinstance(rule["queue"], list), "Queue needs to be of type list."
+        assert isinstance(rule.get("priority", 0), int), "Priority needs to be of type int."
+
+
+class ReadRulesDisk(ReadRules):
 
     '''
     Loads PySeps rules from a directory and monitors the directory for
     changes.
 
+    Changes are detected using inotify.  When inotify is not available the
+    directory is polled every second.
+
+    The modification time, size and content hash of each file is kept so
+    only the files which really changed are parsed again.
+
+    The parsed rules are stored in a sidecar cache file in the directory
+    (CACHE_FILE) along with the modification time, size and content hash of
+    their file.  At startup only the files which are not in the cache or
+    changed since are parsed.  Rules which can not be represented in JSON
+    are not cached.
+
+    Listing, reading and parsing the files as well as writing the cache
+    happens in the gevent threadpool so the other greenthreads keep running
+    while a large directory is loaded.  Files are parsed using libyaml when
+    available.
+
+    The modification time and size of the value files referred to by the
+    anyof: and !anyof: conditions of a rule are kept as well.  When one of
+    them changes, the rule is reported as changed so it gets compiled again.
+
     Parameters:
 
         directory(string):   The directory to load rules from.
                             default: rules/
 
+        cache(bool):        Keeps the parsed rules in a sidecar file.
+                            default: True
+
     '''
 
-    def __init__(self, logger, directory="rules/"):
-        self.logging = logger
+    CACHE_FILE = ".wishbone_match_cache.json"
+    CACHE_VERSION = 1
+
+    def __init__(self, logger, directory="rules/", cache=True):
+        ReadRules.__init__(self, logger)
         self.directory = directory
+        self.cache = cache
 
         self.__createDir(directory)
 
         if not os.access(self.directory, os.R_OK):
             raise Exception("Directory '%s' is not readable. Please verify." % (self.directory))
 
-        self.current_files = self.__readFileList(self.directory)
-        self.config = self.__parseFiles(self.current_files)
+        self.files = {}
+        if self.cache:
+            self.__readCache()
+        self.current_files = self.inThread(self.__readFileList, self.directory)
 
-        spawn(self.__monitorChanges)
+        self.watcher = createWatcher(self.directory, "*", [self.CACHE_FILE, "%s.tmp" % (self.CACHE_FILE)])
         self.__changes = event.Event()
         self.__changes.clear()
+        spawn(self.__monitorChanges)
 
     def __createDir(self, location):
 
@@ -74,64 +144,171 @@ class ReadRulesDisk():
 
     def getRules(self, block=True):
 
-        return self.__parseFiles(self.current_files)
+        rules = self.__parseFiles(self.current_files)
+        if self.cache:
+            self.inThread(self.__writeCache)
+        return rules
 
-    def getRulesWait(self):
+    def getChangesWait(self):
+        '''Blocks until the directory changes and returns a tuple of a dict
+        containing the added and changed rules and a list of the names of the
+        removed rules.'''
 
-        self.__changes.wait()
-        self.__changes.clear()
-        return self.__parseFiles(self.current_files)
+        while True:
+            self.__changes.wait()
+            self.__changes.clear()
+            changed, removed = self.inThread(self.__scan, self.current_files)
+            if changed or removed:
+                if self.cache:
+                    self.inThread(self.__writeCache)
+                return changed, removed
 
     def __monitorChanges(self):
 
-        previous_files = self.__readFileList(self.directory)
-
         while True:
-            current_files = self.__readFileList(self.directory)
-            if DeepDiff(previous_files, current_files, ignore_order=True) != {}:
-                previous_files = current_files
-                self.current_files = current_files
-                self.__changes.set()
-            else:
-                sleep(1)
+            self.watcher.wait()
+            self.current_files = self.inThread(self.__readFileList, self.directory)
+            self.__changes.set()
 
-    def __readFileList(self, directory):
+    def __readFileList(self, directory, warnings):
 
         dir_content = []
         for f in glob("%s/*.yaml" % (directory)):
-            dir_content.append({"filename": f, "mtime": os.path.getmtime(f)})
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            dir_content.append({"filename": f, "mtime": stat.st_mtime, "size": stat.st_size})
         return dir_content
 
     def __parseFiles(self, current_files):
         '''Reads the content of the given directory and creates a dict
         containing the rules.'''
 
-        rules = {}
-        for entry in current_files:
+        self.inThread(self.__scan, current_files)
+        return dict([(name, f["rule"]) for name, f in self.files.items() if f["rule"] is not None])
+
+    def __scan(self, current_files, warnings):
+        '''Compares <current_files> with the known files and parses the
+        files which are new or of which the content changed.  Returns a tuple
+        of a dict containing the new and changed rules and a list of the
+        names of the removed rules.'''
+
+        changed = {}
+        removed = []
+        current = dict([(os.path.abspath(entry["filename"]), entry) for entry in current_files])
+
+        for key_name in list(self.files.keys()):
+            if key_name not in current:
+                if self.files.pop(key_name)["rule"] is not None:
+                    removed.append(key_name)
+
+        for key_name, entry in current.items():
+            known = self.files.get(key_name)
+            if known is not None and known["mtime"] == entry["mtime"] and known["size"] == entry["size"]:
+                self.__checkValueFiles(key_name, known, changed)
+                continue
             try:
-                with open(entry["filename"], 'r') as f:
-                    key_name = os.path.abspath(entry["filename"])
-                    rule = yaml.load("".join(f.readlines()))
-                    try:
-                        self.ruleCompliant(rule)
-                    except Exception as err:
-                        self.logging.warning("Rule %s not valid. Skipped. Reason: %s" % (entry["filename"], err))
-                    else:
-                        rules[key_name] = rule
-            except ParserError as err:
-                self.logging.warning("Failed to parse file %s.  Please validate the YAML syntax in a parser." % (entry["filename"]))
+                with open(entry["filename"], 'rb') as f:
+                    content = f.read()
             except IOError as err:
-                self.logging.warning("Failed to read %s.  Reason: %s" % (entry["filename"], err))
+                warnings.append("Failed to read %s.  Reason: %s" % (entry["filename"], err))
+                continue
+
+            digest = hashlib.sha1(content).hexdigest()
+            if known is not None and known["hash"] == digest:
+                known["mtime"] = entry["mtime"]
+                known["size"] = entry["size"]
+                self.__checkValueFiles(key_name, known, changed)
+                continue
+
+            rule = self.__parseFile(entry["filename"], content, warnings)
+            self.files[key_name] = {"mtime": entry["mtime"], "size": entry["size"], "hash": digest, "rule": rule, "values": self.__valueFiles(rule)}
+            if rule is not None:
+                changed[key_name] = rule
+            elif known is not None and known["rule"] is not None:
+                removed.append(key_name)
+
+        return changed, removed
+
+    def __checkValueFiles(self, key_name, known, changed):
+        '''Adds the rule of <known> to <changed> when one of the value files
+        it refers to changed.'''
+
+        values = self.__valueFiles(known["rule"])
+        if values != known.get("values", {}):
+            known["values"] = values
+            if known["rule"] is not None:
+                changed[key_name] = known["rule"]
+
+    def __valueFiles(self, rule):
+        '''Returns a dict of the value files referred to by <rule> and a
+        list of their modification time and size or None when missing.'''
+
+        files = {}
+        if rule is None:
+            return files
+        for condition in rule["condition"]:
+            for value in condition.values():
+                if isinstance(value, str):
+                    method, _, argument = value.partition(":")
+                    if method in ("anyof", "!anyof") and argument.startswith("@"):
+                        filename = os.path.join(self.directory, argument[1:])
+                        try:
+                            stat = os.stat(filename)
+                            files[filename] = [stat.st_mtime, stat.st_size]
+                        except OSError:
+                            files[filename] = None
+        return files
+
+    def __parseFile(self, filename, content, warnings):
+        '''Returns the validated rule stored in <content> of <filename> or
+        None when invalid.'''
+
+        try:
+            rule = yaml.load(content, Loader=Loader)
+            try:
+                self.ruleCompliant(rule)
             except Exception as err:
-                self.logging.warning("Unknown error parsing file %s.  Skipped.  Reason: %s." % (entry["filename"], err))
+                warnings.append("Rule %s not valid. Skipped. Reason: %s" % (filename, err))
+            else:
+                return rule
+        except ParserError as err:
+            warnings.append("Failed to parse file %s.  Please validate the YAML syntax in a parser." % (filename))
+        except Exception as err:
+            warnings.append("Unknown error parsing file %s.  Skipped.  Reason: %s." % (filename, err))
 
-        return rules
+    def __readCache(self):
+        '''Loads the files known by the cache file, if any.'''
 
-    def ruleCompliant(self, rule):
+        filename = os.path.join(self.directory, self.CACHE_FILE)
+        if not os.path.exists(filename):
+            return
+        try:
+            with open(filename, 'r') as f:
+                cache = json.load(f)
+            if cache.get("version") != self.CACHE_VERSION:
+                raise Exception("Unsupported cache version '%s'." % (cache.get("version")))
+            self.files = cache["files"]
+            self.logging.info("Loaded %s cached rules from %s." % (len(self.files), filename))
+        except Exception as err:
+            self.files = {}
+            self.logging.warning("Failed to load rule cache %s.  Ignored.  Reason: %s" % (filename, err))
 
-        '''Does basic rule validation'''
+    def __writeCache(self, warnings):
+        '''Writes the known files and their rules to the cache file.'''
 
-        assert isinstance(rule["condition"], list), "Condition needs to be of type list."
-        for c in rule["condition"]:
-            assert isinstance(c, dict), "An individual condition needs to be of type dict."
-        assert isinstance(rule["queue"], list), "Queue needs to be of type list."
+        filename = os.path.join(self.directory, self.CACHE_FILE)
+        files = {}
+        for key_name, f in self.files.items():
+            try:
+                if json.loads(json.dumps(f["rule"])) == f["rule"]:
+                    files[key_name] = f
+            except Exception:
+                pass
+        try:
+            with open("%s.tmp" % (filename), 'w') as f:
+                json.dump({"version": self.CACHE_VERSION, "files": files}, f)
+            os.rename("%s.tmp" % (filename), filename)
+        except Exception as err:
+            warnings.append("Failed to write rule cache %s.  Reason: %s" % (filename, err))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  readrulesbulk.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from gevent import spawn
+from gevent import sleep
+from gevent import event
+import os
+import hashlib
+import json
+import sqlite3
+import yaml
+from .readrules import ReadRules, Loader
+from .watchdir import createWatcher
+
+
+class ReadRulesBulk(ReadRules):
+
+    '''
+    The base of the readers loading many rules from a single source.
+
+    Each rule is a document containing a "name" key next to the usual
+    "condition", "queue" and "priority" keys.  The name is removed from the
+    returned rule.
+
+    The hash of each document is kept so only the documents which are new or
+    changed since the previous read are parsed again.  All reading and
+    parsing happens in the gevent threadpool.
+    '''
+
+    def parseDocument(self, origin, text, warnings, name=None):
+        '''Returns a tuple of the name and the validated rule stored in
+        <text> or None when invalid.  <origin> identifies the document in
+        warnings.  When <name> is None, it is taken from the document.'''
+
+        try:
+            if text.lstrip().startswith("{"):
+                rule = json.loads(text)
+            else:
+                rule = yaml.load(text, Loader=Loader)
+        except Exception as err:
+            warnings.append("Failed to parse %s.  Skipped.  Reason: %s" % (origin, err))
+            return None
+        if rule is None:
+            return None
+
+        try:
+            assert isinstance(rule, dict), "A rule needs to be of type dict."
+            if name is None:
+                rule = dict(rule)
+                name = rule.pop("name")
+                assert isinstance(name, str), "Name needs to be of type str."
+            self.ruleCompliant(rule)
+        except KeyError as err:
+            warnings.append("Rule %s not valid. Skipped. Reason: missing key %s" % (origin, err))
+        except Exception as err:
+            warnings.append("Rule %s not valid. Skipped. Reason: %s" % (origin, err))
+        else:
+            return name, rule
+
+
+class ReadRulesFile(ReadRulesBulk):
+
+    '''
+    Loads rules from a single file and monitors it for changes.
+
+    A file with the .jsonl or .json extension contains one JSON rule per
+    line.  A file with the .yaml or .yml extension contains multiple YAML
+    rule documents separated by "---".
+
+    The file is read line by line.  When it changes, it is read again but
+    only the documents of which the content changed are parsed.
+
+    Parameters:
+
+        filename(string):   The file to load rules from.
+    '''
+
+    EXTENSIONS = (".jsonl", ".json", ".yaml", ".yml")
+
+    def __init__(self, logger, filename):
+        ReadRules.__init__(self, logger)
+        self.filename = filename
+        self.json = os.path.splitext(filename)[1] in (".jsonl", ".json")
+
+        if not os.access(self.filename, os.R_OK):
+            raise Exception("File '%s' is not readable. Please verify." % (self.filename))
+
+        self.documents = {}
+        self.stat = None
+
+        self.watcher = createWatcher(os.path.dirname(os.path.abspath(filename)), os.path.basename(filename))
+        self.__changes = event.Event()
+        self.__changes.clear()
+        spawn(self.__monitorChanges)
+
+    def getRules(self, block=True):
+
+        self.documents = {}
+        self.stat = None
+        changed, removed = self.inThread(self.__scan)
+        return changed
+
+    def getChangesWait(self):
+        '''Blocks until the file changes and returns a tuple of a dict
+        containing the added and changed rules and a list of the names of the
+        removed rules.'''
+
+        while True:
+            self.__changes.wait()
+            self.__changes.clear()
+            changed, removed = self.inThread(self.__scan)
+            if changed or removed:
+                return changed, removed
+
+    def __monitorChanges(self):
+
+        while True:
+            self.watcher.wait()
+            self.__changes.set()
+
+    def __scan(self, warnings):
+        '''Reads the file and parses the documents which are new or changed.
+        Returns a tuple of a dict containing the new and changed rules and a
+        list of the names of the removed rules.'''
+
+        try:
+            stat = os.stat(self.filename)
+        except OSError as err:
+            warnings.append("Failed to read %s.  Reason: %s" % (self.filename, err))
+            return {}, []
+        if (stat.st_mtime, stat.st_size) == self.stat:
+            return {}, []
+
+        changed = {}
+        documents = {}
+        names = set()
+        for line, text in self.__split():
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            name = self.documents.get(digest)
+            if name is None or name in names:
+                result = self.parseDocument("%s:%s" % (self.filename, line), text, warnings)
+                if result is None:
+                    continue
+                name, rule = result
+                if name in names:
+                    warnings.append("Rule %s defined more than once in %s. Skipped." % (name, self.filename))
+                    continue
+                changed[name] = rule
+            documents[digest] = name
+            names.add(name)
+
+        removed = [name for name in self.documents.values() if name not in names]
+        self.documents = documents
+        self.stat = (stat.st_mtime, stat.st_size)
+        return changed, removed
+
+    def __split(self):
+        '''Yields tuples of the line number and the text of each document in
+        the file.'''
+
+        with open(self.filename, 'r', encoding="utf-8") as f:
+            if self.json:
+                for number, line in enumerate(f, 1):
+                    if line.strip() != "":
+                        yield number, line
+            else:
+                lines = []
+                start = 1
+                for number, line in enumerate(f, 1):
+                    if line.startswith("---") or line.startswith("..."):
+                        if lines:
+                            yield start, "".join(lines)
+                        lines = []
+                        start = number
+                        if line.startswith("..."):
+                            continue
+                    lines.append(line)
+                if lines:
+                    yield start, "".join(lines)
+
+
+class ReadRulesSQLite(ReadRulesBulk):
+
+    '''
+    Loads rules from a SQLite table and polls it for changes.
+
+    The table needs the following columns:
+
+        name:       The unique name of the rule.
+        rule:       The rule as a JSON or YAML document.
+        version:    A number which increases whenever the row changes such as
+                    a revision counter or an updated_at timestamp.
+
+    The data version of the database is checked every <interval> seconds.
+    When it changed, only the rows with a version equal to or higher than
+    the highest one seen before are read.  The names of all rows are only
+    read when the number of rows shows rows have been deleted.
+
+    Parameters:
+
+        filename(string):   The SQLite database file.
+        table(string):      The table containing the rules.
+                            default: rules
+        interval(float):    The number of seconds between 2 checks.
+                            default: 1
+    '''
+
+    def __init__(self, logger, filename, table="rules", interval=1):
+        ReadRules.__init__(self, logger)
+        self.filename = filename
+        self.table = table
+        self.interval = interval
+
+        if not os.access(self.filename, os.R_OK):
+            raise Exception("Database '%s' is not readable. Please verify." % (self.filename))
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+
+        self.known = {}
+        self.version = None
+        self.data_version = None
+
+    def getRules(self, block=True):
+
+        self.known = {}
+        self.version = None
+        self.data_version = None
+        changed, removed = self.inThread(self.__scan)
+        return changed
+
+    def getChangesWait(self):
+        '''Blocks until the table changes and returns a tuple of a dict
+        containing the added and changed rules and a list of the names of the
+        removed rules.'''
+
+        while True:
+            sleep(self.interval)
+            changed, removed = self.inThread(self.__scan)
+            if changed or removed:
+                return changed, removed
+
+    def __scan(self, warnings):
+        '''Reads the rows which changed since the previous scan.  Returns a
+        tuple of a dict containing the new and changed rules and a list of
+        the names of the removed rules.'''
+
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return {}, []
+
+        if self.version is None:
+            rows = self.connection.execute("SELECT name, rule, version FROM %s" % (self.table))
+        else:
+            rows = self.connection.execute("SELECT name, rule, version FROM %s WHERE version >= ?" % (self.table), (self.version,))
+
+        changed = {}
+        removed = []
+        for name, text, version in rows:
+            if not isinstance(name, str):
+                warnings.append("Row with name %r in %s not valid. Skipped. Reason: Name needs to be text." % (name, self.table))
+                continue
+            known = self.known.get(name)
+            if not isinstance(text, str) or isinstance(version, bool) or not isinstance(version, (int, float)):
+                warnings.append("Rule %s in %s not valid. Skipped. Reason: Rule needs to be text and version a number." % (name, self.table))
+                self.known[name] = (None, False)
+                if known is not None and known[1]:
+                    removed.append(name)
+                continue
+            if self.version is None or version > self.version:
+                self.version = version
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            if known is not None and known[0] == digest:
+                continue
+            result = self.parseDocument("%s in %s" % (name, self.table), text, warnings, name)
+            self.known[name] = (digest, result is not None)
+            if result is not None:
+                changed[name] = result[1]
+            elif known is not None and known[1]:
+                removed.append(name)
+
+        count = self.connection.execute("SELECT count(*) FROM %s" % (self.table)).fetchone()[0]
+        if count != len(self.known):
+            names = set([row[0] for row in self.connection.execute("SELECT name FROM %s" % (self.table))])
+            for name in list(self.known.keys()):
+                if name not in names:
+                    if self.known.pop(name)[1]:
+                        removed.append(name)
+
+        self.data_version = data_version
+        return changed, removed
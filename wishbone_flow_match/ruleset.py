@@ -0,0 +1,664 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ruleset.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .matchrules import EqualString, Equal, AnyOf, Numeral, More, MoreOrEqual, Less, LessOrEqual, Regex, NegRegex, RegexSet
+from bisect import bisect_left, bisect_right
+from . import analyzer
+
+MISSING = object()
+
+
+class Condition():
+
+    '''
+    A single compiled condition of a rule.
+
+    Parameters:
+
+        field(str):         The (dotted) field name the condition applies to.
+        condition(str):     The original condition string.
+        operator(Operator): The compiled operator.
+    '''
+
+    def __init__(self, field, condition, operator):
+
+        self.field = field
+        self.condition = condition
+        self.operator = operator
+        self.path = tuple(field.split('.'))
+        self.regex = isinstance(operator, Regex)
+        self.negated = isinstance(operator, NegRegex)
+        self.numeral = isinstance(operator, Numeral)
+
+    def indexable(self):
+        '''Returns True when the condition requires one of a set of exact
+        values which can be looked up in a FieldIndex.'''
+
+        return type(self.operator) in (EqualString, Equal, AnyOf)
+
+    def ranged(self):
+        '''Returns True when the condition requires a numeral range which
+        can be looked up in a RangeIndex.'''
+
+        return type(self.operator) in (More, MoreOrEqual, Less, LessOrEqual)
+
+
+class Rule():
+
+    '''
+    A compiled rule.
+
+    <destinations> holds a (queue name, header) tuple for each queue of the
+    rule.  The header is the dict of values stored under @tmp.<module name>
+    of the events submitted to that queue.
+
+    Parameters:
+
+        name(str):          The name of the rule.
+        rule(dict):         The rule definition containing condition and queue.
+        match(MatchRules):  The MatchRules instance used to compile conditions.
+    '''
+
+    def __init__(self, name, rule, match):
+
+        if not isinstance(rule, dict):
+            raise Exception("Rule needs to be of type dict.")
+        if not isinstance(rule.get("condition"), list):
+            raise Exception("Condition needs to be of type list.")
+        if not isinstance(rule.get("queue"), list):
+            raise Exception("Queue needs to be of type list.")
+        if not isinstance(rule.get("priority", 0), int) or isinstance(rule.get("priority"), bool):
+            raise Exception("Priority needs to be of type int.")
+
+        self.name = name
+        self.condition = rule["condition"]
+        self.queue = rule["queue"]
+        self.priority = rule.get("priority", 0)
+
+        conditions = []
+        for condition in rule["condition"]:
+            if not isinstance(condition, dict):
+                raise Exception("An individual condition needs to be of type dict.")
+            for field in condition:
+                conditions.append(Condition(field, condition[field], match.compile(condition[field])))
+        self.conditions = tuple(conditions)
+
+        destinations = []
+        for queue in rule["queue"]:
+            if not isinstance(queue, dict):
+                raise Exception("An individual queue needs to be of type dict.")
+            for name, values in queue.items():
+                if values is not None and not isinstance(values, dict):
+                    raise Exception("The values of queue '%s' need to be of type dict." % (name))
+                header = {"rule_file_name": self.name, "condition": self.condition}
+                header.update(values or {})
+                header["queue"] = name
+                destinations.append((name, header))
+        self.destinations = tuple(destinations)
+
+
+class FieldIndex():
+
+    '''
+    Maps the exact values of a field to the rules requiring that value.
+
+    String (==:) and numeral (=:) conditions are kept apart since their
+    values are compared in a different way.  An anyof: condition is stored
+    under each of its values.
+
+    Parameters:
+
+        field(str): The (dotted) name of the indexed field.
+        path(tuple):    The keys leading to the field.
+    '''
+
+    def __init__(self, field, path):
+
+        self.field = field
+        self.path = path
+        self.strings = {}
+        self.numerals = {}
+        self.rules = []
+        self.owned = set()
+
+    @staticmethod
+    def keys(condition):
+        '''Returns the name of the dict and the values under which
+        <condition> is indexed.'''
+
+        if type(condition.operator) is Equal:
+            return "numerals", [condition.operator.value]
+        elif type(condition.operator) is AnyOf:
+            return "strings", sorted(condition.operator.value)
+        else:
+            return "strings", [condition.operator.value]
+
+    def add(self, condition, rule):
+
+        kind, keys = self.keys(condition)
+        values = getattr(self, kind)
+        for value in keys:
+            if (kind, value) not in self.owned:
+                values[value] = list(values.get(value, []))
+                self.owned.add((kind, value))
+            values[value].append(rule)
+        self.rules.append(rule)
+
+    def remove(self, condition, rule):
+
+        kind, keys = self.keys(condition)
+        values = getattr(self, kind)
+        for value in keys:
+            rules = [r for r in values[value] if r is not rule]
+            if rules:
+                values[value] = rules
+            else:
+                del(values[value])
+        self.rules.remove(rule)
+
+    def copy(self):
+        '''Returns a copy which can be modified without affecting this
+        index.'''
+
+        field_index = FieldIndex(self.field, self.path)
+        field_index.strings = dict(self.strings)
+        field_index.numerals = dict(self.numerals)
+        field_index.rules = list(self.rules)
+        return field_index
+
+    def distinct(self):
+        '''Returns the number of distinct indexed values.'''
+
+        return len(self.strings) + len(self.numerals)
+
+    def lookup(self, evaluation, value):
+        '''Returns the rules requiring <value>.  When <value> is a list,
+        the rules requiring one of its elements are returned as well since
+        anyof: conditions match those.'''
+
+        rules = self.strings.get(str(value), [])
+        if isinstance(value, list):
+            rules = list(rules)
+            for element in value:
+                for rule in self.strings.get(str(element), []):
+                    if rule not in rules:
+                        rules.append(rule)
+        if self.numerals:
+            try:
+                rules = rules + self.numerals.get(evaluation.number(self.field, value), [])
+            except Exception:
+                pass
+        return rules
+
+
+class RangeIndex():
+
+    '''
+    Keeps the boundaries of the >:, >=:, <: and <=: conditions of a field
+    sorted so one binary search per operator returns the rules of which the
+    range condition is satisfied by a value.
+
+    Parameters:
+
+        field(str): The (dotted) name of the indexed field.
+        path(tuple):    The keys leading to the field.
+    '''
+
+    def __init__(self, field, path):
+
+        self.field = field
+        self.path = path
+        self.boundaries = dict([(operator, ([], [])) for operator in (More, MoreOrEqual, Less, LessOrEqual)])
+        self.rules = []
+
+    def add(self, condition, rule):
+
+        values, rules = self.boundaries[type(condition.operator)]
+        position = bisect_right(values, condition.operator.value)
+        values.insert(position, condition.operator.value)
+        rules.insert(position, rule)
+        self.rules.append(rule)
+
+    def remove(self, condition, rule):
+
+        values, rules = self.boundaries[type(condition.operator)]
+        position = bisect_left(values, condition.operator.value)
+        while rules[position] is not rule:
+            position += 1
+        del(values[position])
+        del(rules[position])
+        self.rules.remove(rule)
+
+    def copy(self):
+        '''Returns a copy which can be modified without affecting this
+        index.'''
+
+        range_index = RangeIndex(self.field, self.path)
+        range_index.boundaries = dict([(operator, (list(values), list(rules))) for operator, (values, rules) in self.boundaries.items()])
+        range_index.rules = list(self.rules)
+        return range_index
+
+    def lookup(self, evaluation, value):
+        '''Returns the rules of which the range condition is satisfied by
+        <value>.'''
+
+        try:
+            number = evaluation.number(self.field, value)
+        except Exception:
+            return []
+        if number != number:
+            return []
+
+        values, rules = self.boundaries[More]
+        result = rules[:bisect_left(values, number)]
+        values, rules = self.boundaries[MoreOrEqual]
+        result.extend(rules[:bisect_right(values, number)])
+        values, rules = self.boundaries[Less]
+        result.extend(rules[bisect_right(values, number):])
+        values, rules = self.boundaries[LessOrEqual]
+        result.extend(rules[bisect_left(values, number):])
+        return result
+
+
+class RuleSet():
+
+    '''
+    The compiled version of a set of rules.
+
+    A rule set is not modified once it is built.  Loading new rules results
+    into a new rule set replacing the active one.
+
+    Rules which fail to compile are not part of the rule set and are listed
+    in <rejected> along with the reason.
+
+    Each rule with at least one ==: or =: condition is stored in a
+    FieldIndex under the value it requires.  When a rule has more than one of
+    those, the field with the most distinct values over all rules is chosen
+    since that one is the most selective.  Rules without such a condition
+    but with a >:, >=:, <: or <=: condition are stored in the RangeIndex of
+    that field instead.  The remaining rules can not be indexed and are
+    always evaluated.
+
+    <rank> maps each rule name to its position when ordered by descending
+    priority and name.  <fields> is the sorted list of (field, path) tuples
+    referenced by the conditions of all rules.
+
+    When <combine_regex> is True, the re: and !re: patterns of all rules
+    sharing a field are combined into a RegexSet so only the patterns of
+    which the required literal occurs in the field value are run, once per
+    event.
+
+    When <analyze> is True, rules having the same conditions are merged into
+    a single rule to evaluate.  Only the one with the highest rank is
+    evaluated and <merged> maps its name to the other rules which match
+    along with it.  Rules which can never match are rejected unless
+    <keep_unsatisfiable> is True, as they can still match events missing
+    the contradicting field when missing fields are ignored.  The findings
+    of the last update, including the rules of which the conditions are a
+    superset of the conditions of another rule, are stored in <findings>.
+
+    <rules> contains the rules to evaluate while <names> contains all rules.
+
+    Parameters:
+
+        rules(dict):        A dict of rule name/rule definitions.
+        match(MatchRules):  The MatchRules instance used to compile conditions.
+        combine_regex(bool):    Combine the regexes sharing a field.
+        analyze(bool):      Merge rules with the same conditions and reject
+                            rules which can never match.
+        keep_unsatisfiable(bool):   Report rules which can never match
+                                    instead of rejecting them.
+    '''
+
+    def __init__(self, rules, match, combine_regex=True, analyze=False, keep_unsatisfiable=False):
+
+        self.match = match
+        self.combine_regex = combine_regex
+        self.analyze = analyze
+        self.keep_unsatisfiable = keep_unsatisfiable
+        self.rules = ()
+        self.names = {}
+        self.rank = {}
+        self.fields = []
+        self.rejected = {}
+        self.index = {}
+        self.ranges = {}
+        self.unindexed = {}
+        self.placement = {}
+        self.patterns = {}
+        self.regexsets = {}
+        self.signatures = {}
+        self.groups = {}
+        self.containing = {}
+        self.merged = {}
+        self.findings = {}
+
+        self.__owned = set()
+        self.__update(rules, [])
+
+    def patch(self, rules, removed):
+        '''Returns a new rule set containing the rules of this one with
+        <rules> added or replaced and the rule names in <removed> removed.
+
+        Only the new rules are compiled.  The indexes of the fields these
+        rules refer to are copied and updated while all other indexes are
+        shared with this rule set.'''
+
+        ruleset = RuleSet({}, self.match, self.combine_regex, self.analyze, self.keep_unsatisfiable)
+        ruleset.names = dict(self.names)
+        ruleset.signatures = dict(self.signatures)
+        ruleset.groups = dict(self.groups)
+        ruleset.containing = dict(self.containing)
+        ruleset.merged = dict(self.merged)
+        ruleset.index = dict(self.index)
+        ruleset.ranges = dict(self.ranges)
+        ruleset.unindexed = dict(self.unindexed)
+        ruleset.placement = dict(self.placement)
+        ruleset.patterns = dict(self.patterns)
+        ruleset.regexsets = dict(self.regexsets)
+        ruleset.__update(rules, removed)
+        return ruleset
+
+    def __update(self, rules, removed):
+
+        compiled = []
+        for name, rule in rules.items():
+            try:
+                compiled.append(Rule(name, rule, self.match))
+            except Exception as err:
+                self.rejected[name] = err
+
+        if self.analyze:
+            for rule in list(compiled):
+                reason = analyzer.unsatisfiable(rule)
+                if reason is None:
+                    continue
+                elif self.keep_unsatisfiable:
+                    self.findings[rule.name] = "Can only match when fields are missing since %s." % (reason)
+                else:
+                    self.rejected[rule.name] = Exception("Rule can never match since %s." % (reason))
+                    compiled.remove(rule)
+
+        affected = set()
+        touched = set()
+        for name in list(removed) + list(rules.keys()):
+            if name in self.names:
+                rule = self.names.pop(name)
+                if self.analyze:
+                    signature = self.signatures.pop(name)
+                    self.merged.pop(name, None)
+                    if self.__placed(rule):
+                        affected.update(self.__remove(rule))
+                    self.groups[signature] = tuple([r for r in self.groups[signature] if r is not rule])
+                    touched.add(signature)
+                else:
+                    affected.update(self.__remove(rule))
+
+        distinct = self.__distinct(compiled)
+        for rule in compiled:
+            self.names[rule.name] = rule
+            if self.analyze:
+                signature = analyzer.signature(rule)
+                self.signatures[rule.name] = signature
+                self.groups[signature] = tuple(sorted(self.groups.get(signature, ()) + (rule,), key=lambda r: (-r.priority, r.name)))
+                touched.add(signature)
+            else:
+                affected.update(self.__add(rule, distinct))
+
+        # All members which left a group are removed at this point so the
+        # leader of each touched group can be elected.  The only member
+        # which can still be placed is the previous leader.
+        for signature in touched:
+            members = self.groups[signature]
+            if not members:
+                del(self.groups[signature])
+                for condition in signature:
+                    self.containing[condition] = self.containing[condition] - set([signature])
+                    if not self.containing[condition]:
+                        del(self.containing[condition])
+                continue
+            for condition in signature:
+                if signature not in self.containing.get(condition, ()):
+                    self.containing[condition] = self.containing.get(condition, frozenset()) | set([signature])
+            for rule in members[1:]:
+                if self.__placed(rule):
+                    affected.update(self.__remove(rule))
+            if not self.__placed(members[0]):
+                affected.update(self.__add(members[0], distinct))
+            for rule in members:
+                self.merged.pop(rule.name, None)
+            if len(members) > 1:
+                self.merged[members[0].name] = members[1:]
+                for rule in members[1:]:
+                    self.findings[rule.name] = "Merged with rule '%s' having the same conditions." % (members[0].name)
+
+        if self.combine_regex:
+            for field in affected:
+                self.__buildRegexSet(field)
+
+        if self.analyze:
+            self.rules = tuple([members[0] for members in self.groups.values()])
+            for name, other in analyzer.subsumed(self.groups, self.containing, self.signatures, [rule.name for rule in compiled]):
+                self.findings[name] = "Matches a subset of the events matched by rule '%s'." % (other)
+        else:
+            self.rules = tuple(self.names.values())
+        self.rank = dict([(rule.name, position) for position, rule in enumerate(sorted(self.names.values(), key=lambda r: (-r.priority, r.name)))])
+        self.fields = sorted(set([(condition.field, condition.path) for rule in self.rules for condition in rule.conditions]))
+        self.__owned = set()
+
+    def __placed(self, rule):
+
+        if rule is None:
+            return False
+        elif rule.name in self.placement:
+            return self.placement[rule.name][1] in rule.conditions
+        else:
+            return self.unindexed.get(rule.name) is rule
+
+    def expand(self, rules):
+        '''Returns <rules> along with the rules merged into them.'''
+
+        if not self.merged:
+            return rules
+        expanded = []
+        for rule in rules:
+            expanded.append(rule)
+            expanded.extend(self.merged.get(rule.name, ()))
+        return expanded
+
+    def __distinct(self, rules):
+
+        distinct = {}
+        for rule in rules:
+            for condition in rule.conditions:
+                if condition.indexable():
+                    distinct.setdefault(condition.field, set()).update(FieldIndex.keys(condition)[1])
+        return dict([(field, len(values) + (self.index[field].distinct() if field in self.index else 0)) for field, values in distinct.items()])
+
+    def __own(self, kind, field, create=None):
+        '''Returns the <kind> ("index" or "ranges") index of <field> making
+        sure it is not shared with another rule set.'''
+
+        indexes = getattr(self, kind)
+        if (kind, field) not in self.__owned or field not in indexes:
+            if field in indexes:
+                indexes[field] = indexes[field].copy()
+            else:
+                indexes[field] = create()
+            self.__owned.add((kind, field))
+        return indexes[field]
+
+    def __add(self, rule, distinct):
+
+        indexable = [c for c in rule.conditions if c.indexable()]
+        ranged = [c for c in rule.conditions if c.ranged()]
+        if indexable:
+            condition = max(indexable, key=lambda c: distinct.get(c.field, self.index[c.field].distinct() if c.field in self.index else 0))
+            self.__own("index", condition.field, lambda: FieldIndex(condition.field, condition.path)).add(condition, rule)
+            self.placement[rule.name] = ("index", condition)
+        elif ranged:
+            condition = ranged[0]
+            self.__own("ranges", condition.field, lambda: RangeIndex(condition.field, condition.path)).add(condition, rule)
+            self.placement[rule.name] = ("ranges", condition)
+        else:
+            self.unindexed[rule.name] = rule
+
+        affected = set()
+        for condition in rule.conditions:
+            if condition.regex:
+                patterns = self.__ownPatterns(condition.field)
+                pattern = condition.operator.value.pattern
+                patterns[pattern] = patterns.get(pattern, 0) + 1
+                affected.add(condition.field)
+        return affected
+
+    def __remove(self, rule):
+
+        if rule.name in self.placement:
+            kind, condition = self.placement.pop(rule.name)
+            field_index = self.__own(kind, condition.field)
+            field_index.remove(condition, rule)
+            if not field_index.rules:
+                del(getattr(self, kind)[condition.field])
+        else:
+            del(self.unindexed[rule.name])
+
+        affected = set()
+        for condition in rule.conditions:
+            if condition.regex:
+                patterns = self.__ownPatterns(condition.field)
+                pattern = condition.operator.value.pattern
+                patterns[pattern] -= 1
+                if patterns[pattern] == 0:
+                    del(patterns[pattern])
+                affected.add(condition.field)
+        return affected
+
+    def __ownPatterns(self, field):
+
+        if ("patterns", field) not in self.__owned:
+            self.patterns[field] = dict(self.patterns.get(field, {}))
+            self.__owned.add(("patterns", field))
+        return self.patterns[field]
+
+    def __buildRegexSet(self, field):
+
+        patterns = self.patterns.get(field, {})
+        if len(patterns) > 1:
+            self.regexsets[field] = RegexSet(sorted(patterns))
+        elif field in self.regexsets:
+            del(self.regexsets[field])
+
+    def candidates(self, evaluation, ignore_missing_fields=False):
+        '''Returns the rules which can possibly match the event of
+        <evaluation>.
+
+        When <ignore_missing_fields> is True, rules indexed on a field
+        missing from the event are candidates too.'''
+
+        rules = list(self.unindexed.values())
+        for indexes in (self.index, self.ranges):
+            for field_index in indexes.values():
+                value = evaluation.resolve(field_index.field, field_index.path)
+                if value is not MISSING:
+                    rules.extend(field_index.lookup(evaluation, value))
+                elif ignore_missing_fields:
+                    rules.extend(field_index.rules)
+        return rules
+
+    def __len__(self):
+
+        return len(self.rules)
+
+
+class Evaluation():
+
+    '''
+    Holds the state of evaluating a single event against a RuleSet.
+
+    Results which are shared by all rules, such as the field values and the
+    regex patterns found in them, are only calculated once per event.
+
+    Parameters:
+
+        ruleset(RuleSet):   The rule set to evaluate.
+        event(Event):       The event to evaluate.
+    '''
+
+    def __init__(self, ruleset, event):
+
+        self.ruleset = ruleset
+        self.event = event
+        self.data = event.get()
+        self.fields = {}
+        self.numbers = {}
+        self.regex_hits = {}
+
+    def resolve(self, field, path):
+        '''Returns the value of <field> or MISSING when the event does not
+        have it.  <path> are the keys leading to the field.'''
+
+        try:
+            return self.fields[field]
+        except KeyError:
+            value = self.data
+            for key in path:
+                if isinstance(value, dict) and key in value:
+                    value = value[key]
+                else:
+                    value = MISSING
+                    break
+            self.fields[field] = value
+            return value
+
+    def number(self, field, value):
+        '''Returns <value> of <field> converted to float.  The conversion
+        happens only once per field.'''
+
+        try:
+            number = self.numbers[field]
+        except KeyError:
+            try:
+                number = float(value)
+            except Exception as err:
+                number = err
+            self.numbers[field] = number
+        if isinstance(number, Exception):
+            raise number
+        return number
+
+    def test(self, condition, value):
+        '''Returns the result of <condition> applied to <value>.'''
+
+        if condition.numeral:
+            return condition.operator.compare(self.number(condition.field, value), condition.operator.value)
+
+        if condition.regex and condition.field in self.ruleset.regexsets:
+            regexset = self.ruleset.regexsets[condition.field]
+            pattern = condition.operator.value.pattern
+            if pattern in regexset:
+                if condition.field not in self.regex_hits:
+                    self.regex_hits[condition.field] = regexset.search(value)
+                return (pattern in self.regex_hits[condition.field]) != condition.negated
+        return condition.operator(value)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  sharedevent.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from wishbone.event import Event
+
+
+class SharedEvent(Event):
+
+    '''
+    A Wishbone event sharing its @data payload with the event it was made of.
+
+    The header sections (@tmp and @errors) are private copies.  The @data
+    payload is only copied the first time it is modified using set(),
+    delete() or copy().  Modifying the value returned by get() directly can
+    not be detected and affects all events sharing the payload.
+
+    The event the shared events are made of is not protected so it needs to
+    get a private copy of its payload using release() once they are made.
+
+    Parameters:
+
+        event(Event):   The event to share the payload with.
+    '''
+
+    def __init__(self, event):
+
+        self.data = dict(event.data)
+        self.data["@tmp"] = self.deepish_copy(event.data["@tmp"])
+        self.data["@errors"] = self.deepish_copy(event.data["@errors"])
+        self.shared = True
+
+    def set(self, value, key="@data"):
+
+        if self.__touchesData(key):
+            self.__unshare()
+        Event.set(self, value, key)
+
+    def delete(self, key=None):
+
+        if key is None or self.__touchesData(key):
+            self.__unshare()
+        Event.delete(self, key)
+
+    def __touchesData(self, key):
+
+        return key == "@data" or key.startswith("@data.")
+
+    def __unshare(self):
+
+        if self.shared:
+            self.data["@data"] = self.deepish_copy(self.data["@data"])
+            self.shared = False
+
+    @staticmethod
+    def release(event):
+        '''Gives <event>, of which shared events were made, a private copy of
+        its @data payload so modifying it does not affect them.'''
+
+        event.data["@data"] = event.deepish_copy(event.data["@data"])
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tree.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .matchrules import EqualString
+from .ruleset import MISSING
+
+
+def test(condition, evaluation, ignore_missing_fields=False):
+    '''Returns True when the event of <evaluation> passes <condition>.'''
+
+    value = evaluation.resolve(condition.field, condition.path)
+    if value is MISSING:
+        return ignore_missing_fields
+    try:
+        return bool(evaluation.test(condition, value))
+    except Exception:
+        return False
+
+
+class _Node():
+
+    '''
+    A node of a DecisionTree.
+
+    The rules in <emits> match when the node is reached.  When <condition>
+    passes, the node <true> is visited.  A node testing all ==: conditions
+    of a field at once has <children> mapping each of their values to the
+    node to visit instead.  Either way, traversal continues at <next>.
+    '''
+
+    __slots__ = ["emits", "condition", "true", "children", "next"]
+
+    def __init__(self):
+
+        self.emits = ()
+        self.condition = None
+        self.true = None
+        self.children = None
+        self.next = None
+
+
+class DecisionTree():
+
+    '''
+    Compiles the rules of a RuleSet into a tree sharing the conditions the
+    rules have in common, so each of them is tested once instead of once
+    for every rule having it.
+
+    The rules reaching a node are split on the condition most of them have.
+    The ones having it continue below the node without that condition and
+    are skipped when it fails.  The others continue at the next node.  When
+    more of the rules have a ==: condition on the same field, they are split
+    on the value of that field instead so all these conditions are tested
+    with one lookup.  Each rule ends up in a single place so the size of the
+    tree is bound by the number of conditions.
+
+    The result of each other condition is remembered during the evaluation
+    of an event so a condition is tested at most once per event, even when
+    it appears in multiple branches.
+
+    <nodes> holds the size of the tree.  <events> and <tests> count the
+    evaluated events and the conditions tested for them.
+
+    Parameters:
+
+        ruleset(RuleSet):   The rule set to compile.
+        ignore_missing_fields(bool):    A missing field passes the condition.
+    '''
+
+    def __init__(self, ruleset, ignore_missing_fields=False):
+
+        self.ruleset = ruleset
+        self.ignore_missing_fields = ignore_missing_fields
+        self.conditions = {}
+        self.nodes = 0
+        self.events = 0
+        self.tests = 0
+
+        pending = []
+        for rule in ruleset.rules:
+            keys = set()
+            for condition in rule.conditions:
+                key = (condition.field, condition.condition)
+                self.conditions.setdefault(key, condition)
+                keys.add(key)
+            pending.append((rule, frozenset(keys)))
+        self.root = self.__build(pending)
+
+    def __build(self, pending):
+        '''Returns the root node of the tree evaluating the <pending> (rule,
+        condition keys) tuples.'''
+
+        root = _Node()
+        worklist = [(root, pending)]
+        while worklist:
+            current, pending = worklist.pop()
+            self.nodes += 1
+            current.emits = tuple([rule for rule, keys in pending if not keys])
+            pending = [(rule, keys) for rule, keys in pending if keys]
+            if not pending:
+                continue
+
+            counts = {}
+            switches = {}
+            for rule, keys in pending:
+                for key in keys:
+                    counts[key] = counts.get(key, 0) + 1
+                for field in set([key[0] for key in keys if type(self.conditions[key].operator) is EqualString]):
+                    switches[field] = switches.get(field, 0) + 1
+            key = max(counts, key=lambda k: (counts[k], k))
+
+            rest = []
+            if switches and max(switches.values()) > counts[key]:
+                field = max(switches, key=lambda f: (switches[f], f))
+                branches = {}
+                for rule, keys in pending:
+                    switch = [k for k in keys if k[0] == field and type(self.conditions[k].operator) is EqualString]
+                    if switch:
+                        current.condition = self.conditions[switch[0]]
+                        branches.setdefault(self.conditions[switch[0]].operator.value, []).append((rule, keys - frozenset(switch[:1])))
+                    else:
+                        rest.append((rule, keys))
+                current.children = {}
+                for value, branch in branches.items():
+                    current.children[value] = _Node()
+                    worklist.append((current.children[value], branch))
+            else:
+                current.condition = self.conditions[key]
+                passed = []
+                for rule, keys in pending:
+                    if key in keys:
+                        passed.append((rule, keys - frozenset([key])))
+                    else:
+                        rest.append((rule, keys))
+                current.true = _Node()
+                worklist.append((current.true, passed))
+
+            if rest:
+                current.next = _Node()
+                worklist.append((current.next, rest))
+        return root
+
+    def match(self, evaluation):
+        '''Returns the list of rules matching the event of <evaluation>.'''
+
+        matched = []
+        results = {}
+        tests = 0
+        stack = [self.root]
+        while stack:
+            current = stack.pop()
+            while current is not None:
+                matched.extend(current.emits)
+                if current.children is not None:
+                    tests += 1
+                    value = evaluation.resolve(current.condition.field, current.condition.path)
+                    if value is not MISSING:
+                        if str(value) in current.children:
+                            stack.append(current.children[str(value)])
+                    elif self.ignore_missing_fields:
+                        stack.extend(current.children.values())
+                elif current.condition is not None:
+                    try:
+                        result = results[current.condition.field, current.condition.condition]
+                    except KeyError:
+                        result = results[current.condition.field, current.condition.condition] = test(current.condition, evaluation, self.ignore_missing_fields)
+                        tests += 1
+                    if result:
+                        stack.append(current.true)
+                current = current.next
+        self.events += 1
+        self.tests += tests
+        return matched
+
+    def dump(self):
+        '''Yields (name, value) tuples of the size of the tree and the
+        average number of tests per event.'''
+
+        yield "nodes", self.nodes
+        yield "events", self.events
+        yield "tests", self.tests
+        yield "tests_per_event", float(self.tests) / self.events if self.events else 0.0
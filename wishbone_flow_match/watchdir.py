@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  watchdir.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from gevent import sleep
+from gevent.select import select
+from fnmatch import fnmatch
+from glob import glob
+import ctypes
+import ctypes.util
+import struct
+import os
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher():
+
+    '''
+    Waits for files matching <pattern> but none of <exclude> in <directory>
+    to be written, moved or deleted using Linux inotify.
+
+    The inotify file descriptor is waited upon through gevent so waiting
+    does not block other greenthreads and costs nothing while idle.
+
+    Parameters:
+
+        directory(str): The directory to watch.
+        pattern(str):   The file name pattern of the files to watch.
+        exclude(list):  The file name patterns of the files to ignore.
+        debounce(float):    The number of seconds without any further change
+                            after which a burst of changes is reported.
+    '''
+
+    def __init__(self, directory, pattern="*.yaml", exclude=[], debounce=0.1):
+
+        self.directory = directory
+        self.pattern = pattern
+        self.exclude = exclude
+        self.debounce = debounce
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.path.abspath(directory).encode(), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed on %s" % (directory))
+
+    def wait(self):
+        '''Blocks until a change happened followed by <debounce> seconds
+        without any further change.'''
+
+        changed = False
+        while True:
+            timeout = self.debounce if changed else None
+            readable, _, _ = select([self.fd], [], [], timeout)
+            if readable:
+                changed = self.__read() or changed
+            elif changed:
+                return
+
+    def close(self):
+
+        os.close(self.fd)
+
+    def __read(self):
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return False
+
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += length
+            if fnmatch(name, self.pattern) and not any([fnmatch(name, e) for e in self.exclude]):
+                changed = True
+        return changed
+
+
+class PollWatcher():
+
+    '''
+    Waits for files matching <pattern> but none of <exclude> in <directory>
+    to be written, moved or deleted by comparing the modification times of the files every
+    <interval> seconds.
+
+    Parameters:
+
+        directory(str): The directory to watch.
+        pattern(str):   The file name pattern of the files to watch.
+        exclude(list):  The file name patterns of the files to ignore.
+        interval(float):    The number of seconds between 2 checks.
+    '''
+
+    def __init__(self, directory, pattern="*.yaml", exclude=[], interval=1):
+
+        self.directory = directory
+        self.pattern = pattern
+        self.exclude = exclude
+        self.interval = interval
+        self.previous = self.__listing()
+
+    def wait(self):
+        '''Blocks until a change happened.'''
+
+        while True:
+            sleep(self.interval)
+            current = self.__listing()
+            if current != self.previous:
+                self.previous = current
+                return
+
+    def close(self):
+
+        pass
+
+    def __listing(self):
+
+        listing = {}
+        for filename in glob(os.path.join(self.directory, self.pattern)):
+            if any([fnmatch(os.path.basename(filename), e) for e in self.exclude]):
+                continue
+            try:
+                listing[filename] = os.path.getmtime(filename)
+            except OSError:
+                pass
+        return listing
+
+
+def createWatcher(directory, pattern="*.yaml", exclude=[]):
+    '''Returns an InotifyWatcher for <directory> or a PollWatcher when
+    inotify is not available.'''
+
+    try:
+        return InotifyWatcher(directory, pattern, exclude)
+    except Exception:
+        return PollWatcher(directory, pattern, exclude)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  workers.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from collections import deque
+from gevent.lock import Semaphore, BoundedSemaphore
+from wishbone.event import Event
+import gipc
+from .matchrules import MatchRules
+from .ruleset import RuleSet, Evaluation, MISSING
+
+
+def evaluate(ruleset, values, ignore_missing_fields=False, first_match=False):
+    '''Returns a tuple of the names of the rules of <ruleset> matching and
+    not matching the field <values>.'''
+
+    evaluation = Evaluation(ruleset, Event({}))
+    evaluation.fields.update(values)
+    matched = []
+    unmatched = []
+    candidates = ruleset.candidates(evaluation, ignore_missing_fields)
+    if first_match:
+        candidates.sort(key=lambda rule: ruleset.rank[rule.name])
+    for rule in candidates:
+        for condition in rule.conditions:
+            value = evaluation.resolve(condition.field, condition.path)
+            if value is MISSING:
+                if not ignore_missing_fields:
+                    break
+            else:
+                try:
+                    if not evaluation.test(condition, value):
+                        break
+                except Exception:
+                    break
+        else:
+            matched.append(rule.name)
+            if first_match:
+                break
+            continue
+        unmatched.append(rule.name)
+    return matched, unmatched
+
+
+def work(requests, responses, combine_regex, ignore_missing_fields, first_match, directory, analyze):
+    '''The loop of a worker process.  Keeps its own copy of the rule set
+    up to date and returns the matching rule names of each received batch.'''
+
+    match = MatchRules(directory)
+    ruleset = RuleSet({}, match, combine_regex, analyze, ignore_missing_fields)
+    while True:
+        request = requests.get()
+        if request[0] == "batch":
+            responses.put([evaluate(ruleset, values, ignore_missing_fields, first_match) for values in request[1]])
+        elif request[0] == "load":
+            ruleset = RuleSet(request[1], match, combine_regex, analyze, ignore_missing_fields)
+        elif request[0] == "patch":
+            ruleset = ruleset.patch(request[1], request[2])
+        elif request[0] == "stop":
+            break
+
+
+class WorkerPool():
+
+    '''
+    Evaluates batches of events in a pool of worker processes.
+
+    Each worker compiles its own copy of the rule set.  Whenever the rule
+    set of the parent changes, the rules or the changes are sent to all
+    workers and compiled once more by each of them.  Only the values of the
+    fields referenced by the rules are sent to the workers.  The workers
+    return the names of the matching rules which are resolved against the
+    rule set the batch was sent with.
+
+    Batches are distributed round robin over the workers unless <order_by>
+    is defined, in which case all events with the same value for that field
+    go to the same worker.  The results of a worker are received in the
+    order its batches were sent so the order of events sharing a value is
+    retained.
+
+    A worker process which dies is replaced by a new one loading the
+    current rules.  The events of the batches it did not return a result
+    for are handed back by respawn() so they can be failed.
+
+    Parameters:
+
+        size(int):              The number of worker processes.
+        order_by(str):          The field determining the worker of an event.
+        combine_regex(bool):    Combine the regexes sharing a field.
+        ignore_missing_fields(bool):    Missing fields do not fail a condition.
+        first_match(bool):      Stop at the first matching rule.
+        directory(str):         The directory containing the value files.
+        analyze(bool):          Analyze the rule set.
+        in_flight(int):         The max number of batches per worker waiting
+                                for a result.
+    '''
+
+    def __init__(self, size, order_by="", combine_regex=True, ignore_missing_fields=False, first_match=False, directory="", analyze=False, in_flight=2):
+
+        self.size = size
+        self.order_by = order_by
+        self.first_match = first_match
+        self.arguments = (combine_regex, ignore_missing_fields, first_match, directory, analyze)
+        self.ruleset = None
+        self.rules = {}
+        self.processes = []
+        self.requests = []
+        self.responses = []
+        self.pending = []
+        self.locks = []
+        self.slots = []
+        self.__next = 0
+
+        for worker in range(size):
+            self.processes.append(None)
+            self.requests.append(None)
+            self.responses.append(None)
+            self.pending.append(deque())
+            self.locks.append(Semaphore())
+            self.slots.append(BoundedSemaphore(in_flight))
+            self.__start(worker)
+
+    def load(self, ruleset, rules):
+        '''Replaces the rule set of all workers by one built from <rules>.
+        <ruleset> is the parent's version of it.'''
+
+        self.ruleset = ruleset
+        self.rules = dict(rules)
+        for worker in range(self.size):
+            self.__send(worker, ("load", rules))
+
+    def patch(self, ruleset, changed, removed):
+        '''Patches the rule set of all workers with the <changed> rules and
+        <removed> rule names.  <ruleset> is the parent's version of the
+        result.'''
+
+        self.ruleset = ruleset
+        self.rules.update(changed)
+        for name in removed:
+            self.rules.pop(name, None)
+        for worker in range(self.size):
+            self.__send(worker, ("patch", changed, removed))
+
+    def submit(self, events):
+        '''Sends the values of the referenced fields of <events> to the
+        workers.  Blocks while a worker has too many batches in flight.
+        Returns a list of (event, exception) tuples of the events which
+        could not be sent.'''
+
+        batches = [[] for worker in range(self.size)]
+        values = [[] for worker in range(self.size)]
+        order_path = tuple(self.order_by.split('.'))
+        for event in events:
+            evaluation = Evaluation(self.ruleset, event)
+            if self.order_by:
+                worker = hash(repr(evaluation.resolve(self.order_by, order_path))) % self.size
+            else:
+                worker = self.__next
+            batches[worker].append(event)
+            values[worker].append(dict([(field, value) for field, value in [(field, evaluation.resolve(field, path)) for field, path in self.ruleset.fields] if value is not MISSING]))
+        self.__next = (self.__next + 1) % self.size
+
+        failed = []
+        for worker, batch in enumerate(batches):
+            if batch:
+                self.slots[worker].acquire()
+                # The batch is registered and sent while holding the lock
+                # so a respawn can not happen in between.
+                with self.locks[worker]:
+                    self.pending[worker].append((self.ruleset, batch))
+                    try:
+                        self.requests[worker].put(("batch", values[worker]))
+                    except Exception as err:
+                        self.pending[worker].pop()
+                        self.slots[worker].release()
+                        failed.extend([(event, err) for event in batch])
+        return failed
+
+    def receive(self, worker):
+        '''Blocks until the next result of <worker> arrives and returns a
+        tuple of the events, the lists of matching rules and the lists of
+        not matching rules.  Raises EOFError when <worker> died.'''
+
+        results = self.responses[worker].get()
+        ruleset, events = self.pending[worker].popleft()
+        self.slots[worker].release()
+        matched = [[ruleset.names[name] for name in names] for names, other in results]
+        if not self.first_match:
+            matched = [ruleset.expand(rules) for rules in matched]
+        unmatched = [[ruleset.names[name] for name in other] for names, other in results]
+        return events, matched, unmatched
+
+    def respawn(self, worker):
+        '''Replaces <worker> by a new process loading the current rules.
+        Returns the list of events of the batches the old one did not return
+        a result for.'''
+
+        with self.locks[worker]:
+            events = []
+            while self.pending[worker]:
+                events.extend(self.pending[worker].popleft()[1])
+                self.slots[worker].release()
+            process = self.processes[worker]
+            if process.is_alive():
+                process.terminate()
+            process.join(1)
+            for handle in (self.requests[worker], self.responses[worker]):
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+            self.__start(worker)
+            self.requests[worker].put(("load", self.rules))
+        return events
+
+    def stop(self):
+        '''Stops all worker processes.'''
+
+        for worker, process in enumerate(self.processes):
+            try:
+                self.__send(worker, ("stop",))
+            except Exception:
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+    def __start(self, worker):
+
+        requests_reader, requests_writer = gipc.pipe()
+        responses_reader, responses_writer = gipc.pipe()
+        self.processes[worker] = gipc.start_process(target=work, args=(requests_reader, responses_writer) + self.arguments, daemon=True)
+        self.requests[worker] = requests_writer
+        self.responses[worker] = responses_reader
+
+    def __send(self, worker, request):
+
+        with self.locks[worker]:
+            self.requests[worker].put(request)